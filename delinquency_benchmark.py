@@ -0,0 +1,414 @@
+import os
+import functools
+import sqlite3
+import tempfile
+import time
+import pandas as pd
+import numpy as np
+import sqlalchemy as sq
+from sqlalchemy.orm import sessionmaker
+from loggers import get_logger
+from reporting.source.delinquency import delinquency_project as dd
+
+
+def trans_times(rng, n):
+
+    """ transaction timestamps during the day, never at midnight, sqlite compares
+        the stored timestamps as text so a midnight row would drop out of Transdate <= date """
+
+    return pd.Timestamp("2019-01-01") + pd.to_timedelta(
+        rng.integers(0, 900, n) * 24 + rng.integers(1, 24, n), unit="h"
+    )
+
+
+def connect_source(path):
+
+    """ a connection to the source in path with reporting attached, module level
+        so the engine options can be pickled for sharded workers """
+
+    connection = sqlite3.connect(
+        os.path.join(path, "main.db"),
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+    )
+
+    connection.execute(f"attach database '{os.path.join(path, 'reporting.db')}' as reporting")
+
+    return connection
+
+
+def source_options(path):
+
+    """ create_engine options for the source in path """
+
+    return {"creator": functools.partial(connect_source, path)}
+
+
+def build_source_db(n_loans=2000, trans_per_loan=50, convert_share=0.25, seed=0, path=None):
+
+    """ building a sqlite stand in for the reporting views with random loans
+        and bank/adjustment transactions under path (a new temp dir when not given),
+        reporting is an attached database and date columns are declared TIMESTAMP
+        so they come back as datetimes, loans are made at noon so none of them
+        drops out of a Loandate <= date compared as text """
+
+    rng = np.random.default_rng(seed)
+
+    path = str(path or tempfile.mkdtemp(prefix="delinquency_bench_"))
+
+    cnxn = sq.create_engine(f"sqlite:///{os.path.join(path, 'main.db')}", **source_options(path))
+
+    loan_ids = np.arange(1000, 1000 + n_loans)
+
+    business_ids = rng.integers(1, max(n_loans // 2, 2), n_loans)
+
+    loandates = pd.Timestamp("2019-01-01 12:00") + pd.to_timedelta(
+        rng.integers(0, 700, n_loans), unit="D"
+    )
+
+    loans = pd.DataFrame(
+        {
+            "LoanID": loan_ids,
+            "BusinessID": business_ids,
+            "Loandate": loandates,
+            "FirstTransaction": (loandates + pd.Timedelta(days=3)).strftime("%Y-%m-%d"),
+            "LastTransaction": (loandates + pd.Timedelta(days=200)).strftime("%Y-%m-%d"),
+            "loanAmt": rng.integers(5, 100, n_loans) * 1000.0,
+            "calcloan_term": rng.integers(3, 18, n_loans),
+            "AmtOwed": rng.integers(6, 130, n_loans) * 1000.0,
+            "RefinancingFee": rng.integers(0, 5, n_loans) * 100.0,
+            "CarriedOverBal": rng.integers(0, 3, n_loans) * 500.0,
+            "RefinancedInterest": rng.integers(0, 3, n_loans) * 50.0,
+            "AmtOwedFwded": rng.integers(0, 3, n_loans) * 250.0,
+            "DailyPayment": rng.integers(0, 80, n_loans) * 10.0,
+            "PaymentSchedule": rng.choice(["Daily", "Weekly"], n_loans),
+            "CreditScore": rng.integers(400, 900, n_loans).astype(float),
+            "CreditScore2": rng.integers(400, 900, n_loans).astype(float),
+            "YearsInBusiness": rng.integers(0, 60, n_loans).astype(float),
+            "AnnualRevenue": rng.integers(1, 200, n_loans) * 50000.0,
+            "AppType": rng.choice(["New", "Renewal"], n_loans),
+            "industry1": rng.choice(["Retail", "Food", "Services"], n_loans),
+            "industry2": rng.choice(["A", "B"], n_loans),
+            "industry3": rng.choice(["C", "D"], n_loans),
+            "industry4": rng.choice(["E", "F"], n_loans),
+            "RepType": rng.choice(["ISO", "Direct"], n_loans),
+        }
+    )
+
+    timestamp = {"Loandate": sq.types.TIMESTAMP, "Transdate": sq.types.TIMESTAMP}
+
+    loans.to_sql("vw_loans", cnxn, schema="reporting", index=False, dtype=timestamp)
+
+    loans[["LoanID", "BusinessID", "Loandate"]].to_sql(
+        "Loans", cnxn, index=False, dtype=timestamp
+    )
+
+    n_trans = n_loans * trans_per_loan
+
+    trans_loans = rng.choice(loan_ids, n_trans)
+
+    trans_dates = trans_times(rng, n_trans)
+
+    bank = pd.DataFrame(
+        {
+            "ID": np.arange(n_trans),
+            "LoanID": trans_loans,
+            "Transdate": trans_dates,
+            "AmtPaid": np.where(rng.random(n_trans) < 0.05, np.nan, rng.integers(0, 500, n_trans)),
+            "AmtCharged": np.where(rng.random(n_trans) < 0.8, np.nan, rng.integers(0, 50, n_trans)),
+        }
+    )
+
+    bank.to_sql(
+        "vw_BankTransactions_transactions", cnxn, schema="reporting", index=False, dtype=timestamp
+    )
+
+    n_adj = n_trans // 5
+
+    adj_loans = rng.choice(loan_ids, n_adj)
+
+    adj = pd.DataFrame(
+        {
+            "ID": np.arange(n_adj),
+            "BusinessID": business_ids[adj_loans - 1000],
+            "LoanID": adj_loans,
+            "Transdate": trans_times(rng, n_adj),
+            "OwedAmtAmtPaid": np.where(rng.random(n_adj) < 0.1, np.nan, rng.integers(0, 300, n_adj)),
+            "OwedAmtAmtCharged": np.where(rng.random(n_adj) < 0.5, np.nan, rng.integers(0, 100, n_adj)),
+            "TransID": rng.choice([1, 4, 15, 20, 91, 97], n_adj),
+        }
+    )
+
+    converted = rng.choice(loan_ids, int(n_loans * convert_share), replace=False)
+
+    adj.loc[adj["LoanID"].isin(converted) & (rng.random(n_adj) < 0.3), "TransID"] = 34
+
+    adj.to_sql(
+        "vw_AdjustmentTransactions_transactions", cnxn, schema="reporting", index=False, dtype=timestamp
+    )
+
+    return cnxn
+
+
+def legacy_loan_convert(loan_ids, date, cnxn):
+
+    """ the original one query per loan extraction, kept for comparison """
+
+    loan_convert_bank = []
+    for loan_id in loan_ids:
+        bankquery = (
+            f"select LoanID, AmtPaid, AmtCharged "
+            f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}' "
+            f"and LoanID = '{loan_id}';"
+        )
+        loan_convert_bank.append(pd.read_sql(bankquery, cnxn))
+
+    loan_convert_adj = []
+    for loan_id in loan_ids:
+        adjquery = (
+            f"select BusinessID, LoanID, OwedAmtAmtPaid, OwedAmtAmtCharged, TransID, "
+            f" dense_rank() over (partition by BusinessID order by LoanID desc) rnk"
+            f" from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{date}' "
+            f"and LoanID = '{loan_id}' and TransID != 91 and TransID != 97"
+            " and TransID != 34;"
+        )
+        loan_convert_adj.append(pd.read_sql(adjquery, cnxn))
+
+    bank = dd.get_paid_bank(pd.concat(loan_convert_bank))
+
+    adj = dd.get_paid_adj(pd.concat(loan_convert_adj))
+
+    return dd.get_trn_agg(bank, adj)
+
+
+def batched_loan_convert(loan_ids, date, cnxn):
+
+    bank = dd.get_paid_bank(dd.get_loan_convert_bank_data(loan_ids, date, cnxn))
+
+    adj = dd.get_paid_adj(dd.get_loan_convert_adj_data(loan_ids, date, cnxn))
+
+    return dd.get_trn_agg(bank, adj)
+
+
+def legacy_loan_term_calc(df):
+    if (df["calcloan_term"] - df["loan_term_diff"]) < 0:
+        return df["neg_months_convert"]
+    else:
+        return df["calcloan_term"] - df["loan_term_diff"]
+
+
+def legacy_loan_term_diff(x, today):
+    return (today - x) / np.timedelta64(1, "M")
+
+
+def legacy_remain_loan_term(df, today):
+
+    """ the original row wise get_remain_loan_term, kept for comparison """
+
+    df["loan_term_diff"] = df.Loandate.apply(legacy_loan_term_diff, args=(today,))
+
+    df["amt_left_to_pay"] = df["AmtOwedAdj"] - df["AmtPaidTodatehack"]
+
+    df["paymnts_left"] = df["amt_left_to_pay"] / df["DailyPayment"]
+
+    df["paymnts_left"] = np.where(
+        df["paymnts_left"] < 5,
+        df["paymnts_left"],
+        np.floor(df["paymnts_left"] / 5) * 7 + (df["paymnts_left"] % 5),
+    )
+
+    df["neg_months_convert"] = df["paymnts_left"] / 30
+
+    df["remaining_term"] = df[["calcloan_term", "loan_term_diff", "neg_months_convert"]].apply(
+        legacy_loan_term_calc, axis=1
+    )
+
+    return df
+
+
+def timeit(func, *args, repeat=3):
+
+    """ best of repeat wall clock seconds and the last result """
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_loan_convert(cnxn, date):
+
+    loan_ids = dd.get_loan_convert_loans(cnxn)["LoanID"].drop_duplicates().to_list()
+
+    legacy, expected = timeit(legacy_loan_convert, loan_ids, date, cnxn)
+
+    batched, result = timeit(batched_loan_convert, loan_ids, date, cnxn)
+
+    """ the schema reads LoanID as int32, the legacy extraction as int64 """
+
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False, check_index_type=False)
+
+    return legacy, batched
+
+
+def bench_remain_loan_term(date, n_loans=1000000, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    df = pd.DataFrame(
+        {
+            "Loandate": pd.Timestamp("2018-01-01")
+            + pd.to_timedelta(rng.integers(0, 1100, n_loans), unit="D"),
+            "AmtOwedAdj": rng.integers(6, 130, n_loans) * 1000.0,
+            "AmtPaidTodatehack": rng.integers(0, 100, n_loans) * 1000.0,
+            "DailyPayment": rng.integers(2, 80, n_loans) * 10.0,
+            "calcloan_term": rng.integers(3, 18, n_loans),
+        }
+    )
+
+    legacy, expected = timeit(legacy_remain_loan_term, df.copy(), date, repeat=1)
+
+    vectorized, result = timeit(dd.get_remain_loan_term, df.copy(), date, repeat=1)
+
+    pd.testing.assert_frame_equal(expected, result)
+
+    return legacy, vectorized
+
+
+def bench_schema(cnxn, date):
+
+    """ resident memory of the raw and schema typed extracts in MB """
+
+    query = "select * from reporting.vw_loans"
+
+    raw = pd.read_sql(query, cnxn).memory_usage(deep=True).sum()
+
+    typed = dd.read_sql(query, cnxn).memory_usage(deep=True).sum()
+
+    return raw / 1e6, typed / 1e6
+
+
+def bench_backend(date, n_loans=200000, trans_per_loan=25, seed=0):
+
+    """ pandas against polars for the transaction aggregation and base frame
+        on in memory frames, so only the transforms are timed """
+
+    rng = np.random.default_rng(seed)
+
+    n_trans = n_loans * trans_per_loan
+
+    bank = pd.DataFrame(
+        {
+            "LoanID": rng.integers(0, n_loans, n_trans).astype("int32"),
+            "Transdate": pd.Timestamp("2019-01-01")
+            + pd.to_timedelta(rng.integers(0, 900, n_trans), unit="D"),
+            "AmtPaid": rng.integers(0, 500, n_trans).astype(float),
+            "AmtCharged": rng.integers(0, 50, n_trans).astype(float),
+        }
+    )
+
+    adj = pd.DataFrame(
+        {
+            "LoanID": rng.integers(0, n_loans, n_trans // 5).astype("int32"),
+            "OwedAmtAmtPaid": rng.integers(0, 300, n_trans // 5).astype(float),
+            "OwedAmtAmtCharged": rng.integers(0, 100, n_trans // 5).astype(float),
+        }
+    )
+
+    loandates = pd.Timestamp("2019-01-01") + pd.to_timedelta(
+        rng.integers(0, 700, n_loans), unit="D"
+    )
+
+    activefunds = pd.DataFrame(
+        {
+            "LoanID": np.arange(n_loans, dtype="int32"),
+            "Loandate": loandates,
+            "FirstTransaction": loandates + pd.Timedelta(days=3),
+            "AmtOwedAdj": rng.integers(6, 130, n_loans) * 1000.0,
+            "DailyPayment": rng.integers(0, 80, n_loans) * 10.0,
+        }
+    )
+
+    def run(name):
+        ops = dd.get_backend(name)
+        mindate = ops["min_BankTransactions_date"](bank)
+        agg = ops["get_trn_agg"](bank, adj)
+        return ops["base_frame"](activefunds.copy(), agg, mindate, date)
+
+    pandas, expected = timeit(run, "pandas", repeat=1)
+
+    polars, result = timeit(run, "polars", repeat=1)
+
+    pd.testing.assert_frame_equal(
+        expected.reset_index(drop=True), result, check_dtype=False
+    )
+
+    return pandas, polars
+
+
+def row_wise_load(session, df, table, schema="reports"):
+
+    """ one insert statement per row, the throughput the warehouse upload gets today """
+
+    target = sq.table(table, *[sq.column(column) for column in df.columns], schema=schema)
+    for record in dd.bulk_records(df):
+        session.execute(target.insert().values(**record))
+
+
+def bench_upload(n_rows=100000, batch_size=dd.BULK_BATCH_SIZE, seed=0):
+
+    """ row wise inserts against bulk_load into a sqlite stand in for the warehouse """
+
+    rng = np.random.default_rng(seed)
+
+    df = pd.DataFrame(
+        {
+            "loan_id": np.arange(n_rows),
+            "loan_balance": rng.random(n_rows) * 1000,
+            "bins_delinquency": pd.Categorical(rng.choice(["0-3", "4-14", "180+"], n_rows)),
+            "date": pd.Timestamp("2021-03-01"),
+        }
+    )
+
+    engine = sq.create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'wh.db')}")
+
+    @sq.event.listens_for(engine, "connect")
+    def attach_reports(dbapi_connection, connection_record):
+        dbapi_connection.execute("attach database ':memory:' as reports")
+
+    def load(func, *args):
+        session = sessionmaker(bind=engine)()
+        session.execute(sq.text("drop table if exists reports.delinquency_daily"))
+        session.execute(
+            sq.text(
+                "create table reports.delinquency_daily "
+                "(loan_id integer, loan_balance float, bins_delinquency text, date timestamp)"
+            )
+        )
+        func(session, df, "delinquency_daily", *args)
+        session.commit()
+        session.close()
+
+    row_wise, _ = timeit(load, row_wise_load, repeat=1)
+
+    bulk, _ = timeit(load, dd.bulk_load, "reports", batch_size, repeat=1)
+
+    return row_wise, bulk
+
+
+def report(name, old, new):
+    print(f"{name:<30} old {old:8.3f}s  new {new:8.3f}s  speedup {old / new:6.1f}x")
+
+
+if __name__ == "__main__":
+    dd.log = get_logger()
+    today = pd.to_datetime("2021-03-01")
+    cnxn = build_source_db()
+    report("loan convert extraction", *bench_loan_convert(cnxn, today))
+    report("remaining term, 1M loans", *bench_remain_loan_term(today))
+    if dd.pl is not None:
+        report("polars backend, 5M transactions", *bench_backend(today))
+    report("warehouse upload, 100k rows", *bench_upload())
+    print("vw_loans memory MB               raw {:8.2f}   typed {:8.2f}".format(*bench_schema(cnxn, today)))
@@ -1,5 +1,18 @@
+import io
+import os
+import json
+import time
+import hashlib
+import inspect
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from datetime import datetime
 from datetime import timedelta
 from datetime import date
@@ -13,8 +26,100 @@ from reporting.util import reporting_utility as utl
 from models.reporting import Delinquent_Daily
 from models.reporting import Delinquent_Historical
 
+try:
+    import polars as pl
+except ImportError:
+    pl = None
 
-def active_loans(date, cnxn):
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+SOURCE_SCHEMA = {
+    "LoanID": "int32",
+    "BusinessID": "int32",
+    "TransID": "int32",
+    "rnk": "int32",
+    "PaymentSchedule": "category",
+    "AppType": "category",
+    "RepType": "category",
+    "industry1": "category",
+    "industry2": "category",
+    "industry3": "category",
+    "industry4": "category",
+    "Loandate": "datetime64[ns]",
+    "Transdate": "datetime64[ns]",
+    "firstBankTransactionsdate": "datetime64[ns]",
+}
+
+
+def id_dtype(values):
+
+    """ int32 when the ids fit, int64 when they don't so large ids are never wrapped,
+        the nullable Int32 or Int64 when there are nulls """
+
+    ids = pd.to_numeric(pd.Series(values)).dropna()
+
+    info = np.iinfo("int32")
+
+    dtype = "int32" if ids.empty or (ids.min() >= info.min and ids.max() <= info.max) else "int64"
+
+    return dtype.capitalize() if len(ids) < len(values) else dtype
+
+
+def apply_schema(df, schema=SOURCE_SCHEMA):
+
+    """ casting extracted columns (and a LoanID index) to compact dtypes,
+        int32 ids are only narrowed when they fit and fall back to nullable types with nulls """
+
+    for col, dtype in schema.items():
+        if col == df.index.name:
+            df.index = df.index.astype(id_dtype(df.index) if dtype == "int32" else dtype)
+        if col not in df.columns:
+            continue
+        if dtype.startswith("datetime"):
+            df[col] = pd.to_datetime(df[col]).astype(dtype)
+        elif dtype == "int32":
+            df[col] = df[col].astype(id_dtype(df[col]))
+        else:
+            df[col] = df[col].astype(dtype)
+
+    return df
+
+
+def read_sql(query, cnxn, **kwargs):
+
+    """ pd.read_sql with the source schema applied """
+
+    return apply_schema(pd.read_sql(query, cnxn, **kwargs))
+
+
+def shard_filter(shard):
+
+    """ condition keeping the LoanIDs of one BusinessID shard, shard is (index, count),
+        every loan of a business lands in the same shard so the rnkactive and rnk
+        ranks partitioned by BusinessID are unchanged, the modulus is taken non negative
+        and loans with a NULL BusinessID or no Loans row go to shard 0 """
+
+    if shard is None:
+        return ""
+
+    index, count = shard
+
+    bucket = f"((BusinessID % {count}) + {count}) % {count}"
+
+    if index == 0:
+        return (
+            f"and LoanID not in (select LoanID from Loans where LoanID is not null "
+            f"and BusinessID is not null and {bucket} != 0) "
+        )
+
+    return f"and LoanID in (select LoanID from Loans where {bucket} = {index}) "
+
+
+def active_loans(date, cnxn, shard=None):
 
     """ function to load in data and transform it
         AmtOwedFwded is set to 0 for most recent loan
@@ -22,14 +127,14 @@ def active_loans(date, cnxn):
 
     query = (
         f"with x as (select * from reporting.vw_loans where LoanID not in"
-        " ('1','34','57','312')) "
+        f" ('1','34','57','312') {shard_filter(shard)}) "
         ",x2 as (select LoanID, row_number() over "
         f"(partition by BusinessID order by Loandate desc) rnkactive from Loans where "
         f"Loandate <= '{date}'  and LoanID not in ('1','34','57','312'))"
         " select x.*, rnkactive from x left join x2 on x.LoanID = x2.LoanID"
     )
 
-    df = pd.read_sql(query, cnxn)
+    df = read_sql(query, cnxn)
 
     return df
 
@@ -56,53 +161,75 @@ def transform_active_loans(df):
     return df
 
 
-def get_bank_data(date, cnxn):
+def read_sql_chunks(query, cnxn, chunksize):
+
+    """ reading a query in chunks over a server side cursor so the driver
+        doesn't buffer the whole result set """
 
-    """ function to read in data from BankTransactions """
+    with cnxn.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(query, conn, chunksize=chunksize):
+            yield apply_schema(chunk)
+
+
+def get_bank_data(date, cnxn, chunksize=None, shard=None):
+
+    """ function to read in data from BankTransactions
+        Transdate is kept so amounts and first transaction date come from one scan
+        returns an iterator of frames when chunksize is set """
 
     query = (
-        f"select LoanID, AmtPaid, AmtCharged "
-        f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}';"
+        f"select LoanID, Transdate, AmtPaid, AmtCharged "
+        f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}' "
+        f"{shard_filter(shard)};"
     )
 
-    df = pd.read_sql(query, cnxn)
+    if chunksize:
+        return read_sql_chunks(query, cnxn, chunksize)
+
+    df = read_sql(query, cnxn)
 
     return df
 
 
 def get_paid_bank(df):
 
-    """ replacing nulls """
+    """ replacing nulls, the amounts are float even when an empty or all null
+        result came back as object columns """
 
-    df["AmtPaid"] = np.where(df["AmtPaid"].isna(), 0, df["AmtPaid"])
+    df["AmtPaid"] = np.where(df["AmtPaid"].isna(), 0, df["AmtPaid"]).astype(float)
 
-    df["AmtCharged"] = np.where(df["AmtCharged"].isna(), 0, df["AmtCharged"])
+    df["AmtCharged"] = np.where(df["AmtCharged"].isna(), 0, df["AmtCharged"]).astype(float)
 
     return df
 
 
-def get_adj_data(date, cnxn):
+def get_adj_data(date, cnxn, chunksize=None, shard=None):
     """ function to load in AdjustmentTransactions data
-        refi fees for most recent loans are excluded """
+        refi fees for most recent loans are excluded
+        returns an iterator of frames when chunksize is set """
 
     query = (
         f"select BusinessID, LoanID, OwedAmtAmtPaid, OwedAmtAmtCharged, TransID, "
         f" dense_rank() over (partition by BusinessID order by LoanID desc) rnk"
         f" from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{date}' "
-        "and TransID != 15 and TransID != 4;"
+        f"and TransID != 15 and TransID != 4 {shard_filter(shard)};"
     )
 
-    df = pd.read_sql(query, cnxn)
+    if chunksize:
+        return read_sql_chunks(query, cnxn, chunksize)
+
+    df = read_sql(query, cnxn)
     return df
 
 
 def get_paid_adj(df):
 
-    """ replacing nulls """
+    """ replacing nulls, the amounts are float even when an empty or all null
+        result came back as object columns """
 
-    df["OwedAmtAmtPaid"] = np.where(df["OwedAmtAmtPaid"].isna(), 0, df["OwedAmtAmtPaid"])
+    df["OwedAmtAmtPaid"] = np.where(df["OwedAmtAmtPaid"].isna(), 0, df["OwedAmtAmtPaid"]).astype(float)
 
-    df["OwedAmtAmtCharged"] = np.where(df["OwedAmtAmtCharged"].isna(), 0, df["OwedAmtAmtCharged"])
+    df["OwedAmtAmtCharged"] = np.where(df["OwedAmtAmtCharged"].isna(), 0, df["OwedAmtAmtCharged"]).astype(float)
 
     return df
 
@@ -122,21 +249,78 @@ def aggregate(df, credit, debit, varname):
     return agg
 
 
-def get_BankTransactions_date_data(date, cnxn):
-    """ finds minimum BankTransactions transaction date by LoanID """
+LOAN_CONVERT_CHUNKSIZE = 1000
 
-    query = (
-        f"select LoanID, Transdate "
-        f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}';"
-    )
 
-    df = pd.read_sql(query, cnxn)
+def get_loan_convert_loans(cnxn):
+
+    """ function to read in loans with a loan convert (TransID 34) adjustment """
+
+    query = """select LoanID from reporting.vw_AdjustmentTransactions_transactions vtat where TransID = 34"""
+
+    df = read_sql(query, cnxn)
 
     return df
 
 
+def id_chunks(ids, chunksize):
+
+    """ splitting a list of LoanIDs into quoted IN-list strings of at most chunksize ids """
+
+    ids = list(ids)
+
+    for i in range(0, len(ids), chunksize):
+        yield ", ".join(f"'{x}'" for x in ids[i : i + chunksize])
+
+
+def get_loan_convert_bank_data(loan_ids, date, cnxn, chunksize=LOAN_CONVERT_CHUNKSIZE):
+
+    """ function to read in BankTransactions for loan convert loans,
+        one query per chunk of LoanIDs instead of one per loan """
+
+    frames = []
+    for in_list in id_chunks(loan_ids, chunksize):
+        query = (
+            f"select LoanID, AmtPaid, AmtCharged "
+            f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}' "
+            f"and LoanID in ({in_list});"
+        )
+        frames.append(read_sql(query, cnxn))
+
+    if not frames:
+        return pd.DataFrame(columns=["LoanID", "AmtPaid", "AmtCharged"])
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_loan_convert_adj_data(loan_ids, date, cnxn, chunksize=LOAN_CONVERT_CHUNKSIZE):
+
+    """ function to read in AdjustmentTransactions for loan convert loans in chunks
+        rnk is partitioned by LoanID as well so it matches the old one loan per query ranks """
+
+    frames = []
+    for in_list in id_chunks(loan_ids, chunksize):
+        query = (
+            f"select BusinessID, LoanID, OwedAmtAmtPaid, OwedAmtAmtCharged, TransID, "
+            f" dense_rank() over (partition by BusinessID, LoanID order by LoanID desc) rnk"
+            f" from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{date}' "
+            f"and LoanID in ({in_list}) and TransID != 91 and TransID != 97"
+            " and TransID != 34;"
+        )
+        frames.append(read_sql(query, cnxn))
+
+    if not frames:
+        return pd.DataFrame(
+            columns=["BusinessID", "LoanID", "OwedAmtAmtPaid", "OwedAmtAmtCharged", "TransID", "rnk"]
+        )
+
+    return pd.concat(frames, ignore_index=True)
+
+
 def min_BankTransactions_date(df):
 
+    """ finds minimum BankTransactions transaction date by LoanID """
+
     mindate = df.groupby("LoanID")["Transdate"].min()
 
     mindate = pd.DataFrame(mindate)
@@ -151,11 +335,7 @@ def get_business_days(df, date):
     """ function to get # business days between the start date of a loan and the date of analysis for daily loans
         excludes federal holidays """
 
-    usa = USFederalHolidayCalendar()
-
-    holiday = usa.holidays(start="2009-01-01", end=date)
-
-    holiday = holiday.astype(str)
+    holiday = business_calendar().holidays
 
     enddate = date + timedelta(days=1)
 
@@ -167,914 +347,3055 @@ def get_business_days(df, date):
         )
 
 
-def weeks_between(start_date, end_date):
-
-    """ function to get the # weeks between the start date of a loan and the date of analysis for weekly loans """
+def federal_holidays(end, start="2009-01-01"):
 
-    weeks = rrule.rrule(rrule.WEEKLY, dtstart=start_date, until=end_date)
+    """ federal holidays as datetime64[D], built once per run instead of once per row """
 
-    return weeks.count()
+    usa = USFederalHolidayCalendar()
 
+    return usa.holidays(start=start, end=end).values.astype("datetime64[D]")
 
-def get_weeks(df, date):
 
-    """ function to return the # weeks for weekly loans """
+class BusinessCalendar:
 
-    if df["PaymentSchedule"] == "weekly":
-        return weeks_between(df["bdstartdate"], date)
-    else:
-        return np.nan
+    """ business day calendar over a fixed date range with a dense cumulative
+        business day index, so counts and offsets for whole columns are array lookups
+        dates outside the range fall back to numpy with the same holidays
+        holidays=False gives a plain Monday to Friday calendar """
 
+    def __init__(self, start="2009-01-01", end=None, holidays=True):
 
-def date_by_subtracting_business_minutes(subtract_minutes, from_date):
+        if end is None:
+            end = date.today() + timedelta(days=730)
 
-    """ getting the number of business days past since start of loan """
+        self.start = np.datetime64(pd.to_datetime(start).date())
 
-    usa = USFederalHolidayCalendar()
+        self.end = np.datetime64(pd.to_datetime(end).date())
 
-    holiday = usa.holidays(start="2009-01-01", end=from_date)
+        if holidays:
+            self.holidays = federal_holidays(str(self.end), str(self.start))
+        else:
+            self.holidays = np.array([], dtype="datetime64[D]")
 
-    holiday = holiday.astype(str)
+        self.build()
 
-    business_minutes_to_subtract = subtract_minutes
+    def build(self):
 
-    current_date = from_date
+        """ ordinal[i] is the number of business days before start + i days,
+            busdays[k] is the k-th business day of the range """
 
-    while business_minutes_to_subtract > 0:
-        current_date -= timedelta(minutes=1)
-        weekday = current_date.weekday()
-        if weekday >= 5:  # sunday = 6
-            continue
-        if current_date in holiday:
-            continue
-        business_minutes_to_subtract -= 1
-    return current_date
+        self.calendar = np.busdaycalendar(holidays=self.holidays)
 
+        days = np.arange(self.start, self.end + 1)
 
-def expectedamt(df):
+        busday = np.is_busday(days, busdaycal=self.calendar)
 
-    """ function to return expected amt paid as of analysis date for loans """
+        self.ordinal = np.concatenate([[0], np.cumsum(busday)]).astype("int64")
 
-    if df["DailyPayment"] == 0:
-        return np.nan
-    elif df["PaymentSchedule"] == "weekly":
-        return df["DailyPayment"] * 5 * df["weekspassed"]
-    else:
-        return df["DailyPayment"] * df["dayspassed"]
+        self.busdays = days[busday]
 
+    def position(self, days):
+        return (days - self.start).astype("int64")
 
-def get_today():
+    def covers(self, days):
+        return (days >= self.start) & (days <= self.end)
 
-    """ getting date of analysis (current), today minus 2 business days """
+    def count(self, begin, end):
 
-    today = date.today()
+        """ np.busday_count(begin, end), which counts [begin, end) forwards
+            and (end, begin] negated when end is before begin """
 
-    bd = pd.tseries.offsets.BusinessDay(n=-2)
+        begin = np.asarray(begin, dtype="datetime64[D]")
 
-    minus2bd = today + bd
+        end = np.broadcast_to(np.asarray(end, dtype="datetime64[D]"), begin.shape)
 
-    return minus2bd
+        inside = self.covers(begin) & self.covers(end)
 
+        shift = (begin[inside] > end[inside]).astype("int64")
 
-def get_trn_agg(bank, adj):
+        result = np.empty(begin.shape, dtype="int64")
 
-    """ getting and aggregating transaction data to get total amount
-    paid to date """
+        result[inside] = (
+            self.ordinal[self.position(end[inside]) + shift]
+            - self.ordinal[self.position(begin[inside]) + shift]
+        )
 
-    aggbank = aggregate(bank, "AmtPaid", "AmtCharged", "bankamt")
+        result[~inside] = np.busday_count(begin[~inside], end[~inside], busdaycal=self.calendar)
 
-    aggadj = aggregate(adj, "OwedAmtAmtPaid", "OwedAmtAmtCharged", "adjamt")
+        return result
 
-    agg = pd.merge(aggbank, aggadj, how="outer", on="LoanID")
+    def offset(self, days, offsets):
 
-    agg["bankamt"] = np.where(agg["bankamt"].isna(), 0, agg["bankamt"])
+        """ np.busday_offset(days, offsets, roll="forward") """
 
-    agg["adjamt"] = np.where(agg["adjamt"].isna(), 0, agg["adjamt"])
+        days = np.asarray(days, dtype="datetime64[D]")
 
-    agg["AmtPaidTodate"] = agg["bankamt"] + agg["adjamt"]
+        days, offsets = np.broadcast_arrays(days, np.asarray(offsets, dtype="int64"))
 
-    agg.drop(["bankamt", "adjamt"], axis=1, inplace=True)
+        inside = self.covers(days)
 
-    return agg
+        index = np.full(days.shape, -1, dtype="int64")
 
+        index[inside] = self.ordinal[self.position(days[inside])] + offsets[inside]
 
-def merge_data(df1, df2, df3):
+        inside &= (index >= 0) & (index < len(self.busdays))
 
-    """ merging loan and transaction data """
+        result = np.empty(days.shape, dtype="datetime64[D]")
 
-    df = pd.merge(df1, df2, how="left", on="LoanID")
+        result[inside] = self.busdays[index[inside]]
 
-    df = pd.merge(df, df3, how="left", on="LoanID")
+        result[~inside] = np.busday_offset(
+            days[~inside], offsets[~inside], roll="forward", busdaycal=self.calendar
+        )
 
-    return df
+        return result
 
+    def is_busday(self, days):
+        return np.is_busday(np.asarray(days, dtype="datetime64[D]"), busdaycal=self.calendar)
 
-def pymnt_start(df):
+    def save(self, path):
+        np.savez(path, start=self.start, end=self.end, holidays=self.holidays)
 
-    """ getting appropriate payment start date """
+    @classmethod
+    def load(cls, path):
 
-    df["firstBankTransactionsdate"] = pd.to_datetime(df["firstBankTransactionsdate"])
+        """ a saved calendar, rebuilt from its stored range and holidays """
 
-    return np.where(
-        df["firstBankTransactionsdate"].isna(), df["FirstTransaction"], df["firstBankTransactionsdate"]
-    )
+        saved = np.load(path)
 
+        calendar = cls.__new__(cls)
 
-def amt_paid(df):
+        calendar.start = saved["start"][()]
 
-    """ consolidating amt paid for edge cases """
+        calendar.end = saved["end"][()]
 
-    return np.where(df["AmtPaidTodate"].isna(), 0, df["AmtPaidTodate"])
+        calendar.holidays = saved["holidays"]
 
+        calendar.build()
 
-def select_df(df, today):
+        return calendar
 
-    """ filtering df for edge cases and active loans """
 
-    df = df[df["Loandate"] <= today]
+CALENDAR_CACHE = None
 
-    df = df[df["DailyPayment"] > 1]
+calendars = {}
 
-    return df[df["loanBalance"] > 1]
 
+def business_calendar(holidays=True):
 
-def time_passed(df, today):
+    """ the shared BusinessCalendar for this process, persisted under
+        CALENDAR_CACHE when it is set and reloaded while it still covers today """
 
-    """ getting days and weeks passed for each loan,
-    0 for loans not yet started payment or invalid start date """
+    if holidays in calendars:
+        return calendars[holidays]
 
-    df["dayspassed"] = df[["PaymentSchedule", "bdstartdate"]].apply(
-        get_business_days, args=[today], axis=1
-    )
+    path = None
+    if CALENDAR_CACHE:
+        name = "business_calendar.npz" if holidays else "weekday_calendar.npz"
+        path = os.path.join(CALENDAR_CACHE, name)
 
-    df["dayspassed"] = np.where(
-        (df["bdstartdate"] > today)
-        | (df["bdstartdate"] < pd.to_datetime("2011-01-01"))
-        | (df["firstBankTransactionsdate"].isna()),
-        0,
-        df["dayspassed"],
-    )
+    calendar = None
+    if path and os.path.exists(path):
+        calendar = BusinessCalendar.load(path)
+        if calendar.end < np.datetime64(date.today() + timedelta(days=30)):
+            calendar = None
 
-    df["weekspassed"] = df[["PaymentSchedule", "bdstartdate"]].apply(
-        get_weeks, args=[today], axis=1
-    )
+    if calendar is None:
+        calendar = BusinessCalendar(holidays=holidays)
+        if path:
+            os.makedirs(CALENDAR_CACHE, exist_ok=True)
+            calendar.save(path)
 
-    df["weekspassed"] = np.where(
-        (df["bdstartdate"] > today)
-        | (df["bdstartdate"] < pd.to_datetime("2011-01-01"))
-        | (df["firstBankTransactionsdate"].isna()),
-        0,
-        df["weekspassed"],
-    )
+    calendars[holidays] = calendar
 
-    return df
+    return calendar
 
 
-def delinquent_amount(df):
+def business_days_passed(df, date):
 
-    """ calculating amt delinquent """
+    """ vectorized get_business_days, one lookup on the shared calendar for the whole column
+        NaN for weekly loans and loans without a start date """
 
-    df["AmtDelinquent"] = np.where(
-        df["ExpectedAmt"] <= df["AmtOwedAdj"],
-        df["ExpectedAmt"] - df["AmtPaidTodatehack"],
-        df["AmtOwedAdj"] - df["AmtPaidTodatehack"],
-    )
+    start = df["bdstartdate"].values.astype("datetime64[D]")
 
-    return np.where(df["AmtDelinquent"] < 0, 0, df["AmtDelinquent"])
+    enddate = np.datetime64(pd.to_datetime(date).date() + timedelta(days=1))
 
+    daily = (df["PaymentSchedule"] != "weekly").values & ~np.isnat(start)
 
-def get_caldays(df, today):
+    days = np.full(len(df), np.nan)
 
-    """ getting calendar days delinquent """
+    days[daily] = business_calendar().count(start[daily], enddate)
 
-    df["minutesbehind"] = df["pymnts_delinquent"] * 24 * 60
+    return days
 
-    df["minutesbehind"] = round(df["minutesbehind"])
 
-    df["minutesbehind"] = np.where(
-        df["minutesbehind"] == np.inf, 1, df["minutesbehind"]
-    )
+def weeks_between(start_date, end_date):
 
-    df["minutesbehind"] = df.minutesbehind.apply(lambda x: int(x))
+    """ function to get the # weeks between the start date of a loan and the date of analysis for weekly loans """
 
-    df["datebehind"] = df.minutesbehind.apply(
-        lambda x: date_by_subtracting_business_minutes(x, today)
-    )
+    weeks = rrule.rrule(rrule.WEEKLY, dtstart=start_date, until=end_date)
 
-    df["CalDays"] = today - df["datebehind"]
+    return weeks.count()
 
-    return df["CalDays"] / timedelta(days=1)
 
+def weeks_elapsed(start_date, end_date):
 
-def loan_term_calc(df):
+    """ vectorized weeks_between, counting weekly occurrences from start_date
+        up to and including end_date from the day difference, NaN for missing starts """
 
-    """ getting the remaining loan_term when correcting for overdue loans """
+    start = np.asarray(pd.to_datetime(start_date), dtype="datetime64[ns]")
 
-    if (df["calcloan_term"] - df["loan_term_diff"]) < 0:
-        return df["neg_months_convert"]
-    else:
-        return df["calcloan_term"] - df["loan_term_diff"]
+    end = np.asarray(pd.to_datetime(end_date), dtype="datetime64[ns]")
 
+    missing = np.isnat(start)
 
-def loan_term_diff(x, today):
-    return (today - x) / np.timedelta64(1, "M")
+    start = np.where(missing, end, start)
 
+    weeks = (end - start) // np.timedelta64(7, "D") + 1
 
-def get_remain_loan_term(df, today):
+    weeks = np.where(end < start, 0, weeks).astype(float)
 
-    """ calculating the difference in passed loan_term versus full loan_term OR payments left in calendar days
-      to use  when calculating remaining loan_term """
+    return np.where(missing, np.nan, weeks)
 
-    df["loan_term_diff"] = df.Loandate.apply(loan_term_diff, args=(today,))
 
-    df["amt_left_to_pay"] = df["AmtOwedAdj"] - df["AmtPaidTodatehack"]
+def weeks_passed(df, date):
 
-    df["paymnts_left"] = df["amt_left_to_pay"] / df["DailyPayment"]
+    """ vectorized get_weeks, NaN for loans that aren't weekly """
 
-    df["paymnts_left"] = np.where(
-        df["paymnts_left"] < 5,
-        df["paymnts_left"],
-        np.floor(df["paymnts_left"] / 5) * 7 + (df["paymnts_left"] % 5),
+    return np.where(
+        df["PaymentSchedule"] == "weekly", weeks_elapsed(df["bdstartdate"], date), np.nan
     )
 
-    df["neg_months_convert"] = df["paymnts_left"] / 30
 
-    df["remaining_term"] = df[["calcloan_term", "loan_term_diff", "neg_months_convert"]].apply(
-        loan_term_calc, axis=1
-    )
+def get_weeks(df, date):
 
-    return df
+    """ function to return the # weeks for weekly loans """
 
+    if df["PaymentSchedule"] == "weekly":
+        return weeks_between(df["bdstartdate"], date)
+    else:
+        return np.nan
 
-def days_in_last_week(df, today):
 
-    """ getting the amount of days passed in the last week """
+def date_by_subtracting_business_minutes(subtract_minutes, from_date):
 
-    lastmonday = today - timedelta(days=today.weekday())
+    """ getting the number of business days past since start of loan """
 
-    df["daysinlastweek"] = today - lastmonday
+    usa = USFederalHolidayCalendar()
 
-    df["daysinlastweek"] = df["daysinlastweek"] + timedelta(days=1)
+    holiday = usa.holidays(start="2009-01-01", end=from_date)
 
-    df["daysinlastweek"] = df["daysinlastweek"].days
+    holiday = holiday.astype(str)
 
-    df["daysinlastweek"] = np.float64(df["daysinlastweek"])
+    business_minutes_to_subtract = subtract_minutes
 
-    return df
+    current_date = from_date
+
+    while business_minutes_to_subtract > 0:
+        current_date -= timedelta(minutes=1)
+        weekday = current_date.weekday()
+        if weekday >= 5:  # sunday = 6
+            continue
+        if current_date in holiday:
+            continue
+        business_minutes_to_subtract -= 1
+    return current_date
 
 
-def clean_caldays(df, today):
+MINUTES_PER_DAY = 24 * 60
 
-    """ returing # payments delinquent for calendar days behind when
-    the payments are less than the days in this week so far """
 
-    df = df.apply(days_in_last_week, args=[today], axis=1)
+def dates_by_subtracting_business_minutes(minutes, from_date):
 
-    df["CalDays"] = np.where(
-        df["pymnts_delinquent"] <= df["daysinlastweek"],
-        df["pymnts_delinquent"],
-        df["CalDays"],
-    )
+    """ vectorized date_by_subtracting_business_minutes using whole weekday
+        arithmetic, the minutes left on from_date are used first, then whole
+        weekdays via np.busday_offset and the remainder from the end of that day
+        holidays are not skipped, matching the loop whose string holiday index
+        never contains a Timestamp """
 
-    df["CalDays"] = np.where(df["pymnts_delinquent"] < 0.001, 0, df["CalDays"])
+    minutes = np.asarray(minutes, dtype="int64")
 
-    return np.where(df["minutesbehind"] == 1, np.nan, df["CalDays"])
+    from_date = pd.to_datetime(from_date)
 
+    day = np.datetime64(from_date.date())
 
-def pyment_info(df):
+    offset = (from_date - from_date.normalize()).to_timedelta64()
 
-    """ getting the amount of payments expected to date and payments
-    actually paid to date """
+    weekdays = business_calendar(holidays=False)
 
-    df["pymnts_expected"] = df["dayspassed"].fillna(df["weekspassed"])
+    minutes_today = int(offset // np.timedelta64(1, "m")) if weekdays.is_busday(day) else 0
 
-    df["pymnts_paid"] = np.where(
-        df["PaymentSchedule"] == "weekly",
-        df["AmtPaidTodatehack"] / (df["DailyPayment"] * 5),
-        df["AmtPaidTodatehack"] / df["DailyPayment"],
-    )
+    seconds = offset % np.timedelta64(1, "m")
 
-    return df
+    result = np.full(len(minutes), np.datetime64(from_date), dtype="datetime64[ns]")
 
+    today = (minutes > 0) & (minutes <= minutes_today)
 
-def bins(df):
+    result[today] = np.datetime64(from_date) - minutes[today].astype("timedelta64[m]")
 
-    """ binning vars of analysis """
+    earlier = minutes > minutes_today
 
-    df["DelinquencyBins"] = pd.cut(
-        df["CalDays"],
-        [-1, 4, 15, 30, 60, 90, 120, 150, 180, np.inf],
-        labels=[
-            "0-3",
-            "4-14",
-            "15-29",
-            "30-59",
-            "60-89",
-            "90-119",
-            "120-149",
-            "150-179",
-            "180+",
-        ],
-        right=False,
-    )
+    days, remainder = np.divmod(minutes[earlier] - minutes_today - 1, MINUTES_PER_DAY)
+
+    busday = weekdays.offset(day, -(days + 1))
 
-    df["DelinquencyBins"] = np.where(
-        df["CalDays"] == np.inf, np.nan, df["DelinquencyBins"]
+    result[earlier] = (
+        busday.astype("datetime64[m]")
+        + (MINUTES_PER_DAY - 1 - remainder).astype("timedelta64[m]")
+        + seconds
     )
 
-    df["AnnualRevenueBins"] = np.where(
-        df.AnnualRevenue.isnull(),
-        "No Rev Info",
-        pd.cut(
-            df["AnnualRevenue"],
-            [
-                -np.inf,
-                120000,
-                175000,
-                200000,
-                500000,
-                1000000,
-                2000000,
-                5000000,
-                10000000,
-                np.inf,
-            ],
-            labels=[
-                "0-119K",
-                "120-174K",
-                "175-199K",
-                "200-499K",
-                "500-999K",
-                "1-2M",
-                "2-5M",
-                "5-10M",
-                ">=10M",
-            ],
-            right=False,
+    return result
+
+
+def expectedamt(df):
+
+    """ function to return expected amt paid as of analysis date for loans """
+
+    if df["DailyPayment"] == 0:
+        return np.nan
+    elif df["PaymentSchedule"] == "weekly":
+        return df["DailyPayment"] * 5 * df["weekspassed"]
+    else:
+        return df["DailyPayment"] * df["dayspassed"]
+
+
+def analysis_date(day):
+
+    """ the date of analysis of a run on day, day minus 2 business days
+        (weekdays only, like pandas BusinessDay) """
+
+    day = np.datetime64(pd.Timestamp(day).date())
+
+    minus2bd = business_calendar(holidays=False).offset(day, -2)
+
+    return pd.Timestamp(minus2bd[()])
+
+
+def get_today():
+
+    """ getting date of analysis (current) """
+
+    return analysis_date(date.today())
+
+
+def get_trn_agg(bank, adj):
+
+    """ getting and aggregating transaction data to get total amount
+    paid to date """
+
+    aggbank = aggregate(bank, "AmtPaid", "AmtCharged", "bankamt")
+
+    aggadj = aggregate(adj, "OwedAmtAmtPaid", "OwedAmtAmtCharged", "adjamt")
+
+    return merge_trn_agg(aggbank, aggadj)
+
+
+def merge_trn_agg(aggbank, aggadj):
+
+    """ combining per loan bank and adjustment amounts into total amount paid to date """
+
+    agg = pd.merge(aggbank, aggadj, how="outer", on="LoanID")
+
+    agg["bankamt"] = np.where(agg["bankamt"].isna(), 0, agg["bankamt"])
+
+    agg["adjamt"] = np.where(agg["adjamt"].isna(), 0, agg["adjamt"])
+
+    agg["AmtPaidTodate"] = agg["bankamt"] + agg["adjamt"]
+
+    agg.drop(["bankamt", "adjamt"], axis=1, inplace=True)
+
+    return agg
+
+
+FOLD_BATCH = 32
+
+
+def fold_chunks(chunks, spec, batch=FOLD_BATCH):
+
+    """ folding chunks into per LoanID aggregates, the per chunk partials are kept
+        and regrouped together every batch chunks and at the end, so the accumulator
+        is regrouped once per batch instead of once per chunk """
+
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk.groupby("LoanID").agg(spec))
+        if len(parts) > batch:
+            parts = [pd.concat(parts).groupby(level=0).agg(spec)]
+
+    if not parts:
+        return None
+
+    if len(parts) == 1:
+        return parts[0]
+
+    return pd.concat(parts).groupby(level=0).agg(spec)
+
+
+def stream_bank_agg(date, cnxn, chunksize, shard=None):
+
+    """ streaming version of get_bank_data + aggregate + min_BankTransactions_date """
+
+    chunks = (get_paid_bank(chunk) for chunk in get_bank_data(date, cnxn, chunksize, shard))
+
+    acc = fold_chunks(chunks, {"AmtPaid": "sum", "AmtCharged": "sum", "Transdate": "min"})
+
+    if acc is None:
+        acc = pd.DataFrame(
+            columns=["AmtPaid", "AmtCharged", "Transdate"], index=pd.Index([], name="LoanID")
+        )
+
+    aggbank = pd.DataFrame({"bankamt": acc["AmtPaid"] - acc["AmtCharged"]})
+
+    mindate = acc[["Transdate"]].rename(columns={"Transdate": "firstBankTransactionsdate"})
+
+    return aggbank, mindate
+
+
+def stream_adj_agg(date, cnxn, chunksize, shard=None):
+
+    """ streaming version of get_adj_data + aggregate """
+
+    chunks = (get_paid_adj(chunk) for chunk in get_adj_data(date, cnxn, chunksize, shard))
+
+    acc = fold_chunks(chunks, {"OwedAmtAmtPaid": "sum", "OwedAmtAmtCharged": "sum"})
+
+    if acc is None:
+        acc = pd.DataFrame(
+            columns=["OwedAmtAmtPaid", "OwedAmtAmtCharged"], index=pd.Index([], name="LoanID")
+        )
+
+    return pd.DataFrame({"adjamt": acc["OwedAmtAmtPaid"] - acc["OwedAmtAmtCharged"]})
+
+
+def since_filter(since):
+
+    """ lower Transdate bound for incremental reads """
+
+    return f"and Transdate > '{since}' " if since is not None else ""
+
+
+def get_bank_agg_data(date, cnxn, since=None, shard=None):
+
+    """ pushdown version of get_bank_data + aggregate + min_BankTransactions_date,
+        the database returns one row per LoanID
+        since limits it to transactions after a watermark """
+
+    query = (
+        f"select LoanID, sum(coalesce(AmtPaid, 0)) - sum(coalesce(AmtCharged, 0)) bankamt, "
+        f"min(Transdate) firstBankTransactionsdate "
+        f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}' "
+        f"{since_filter(since)}{shard_filter(shard)}group by LoanID;"
+    )
+
+    df = read_sql(query, cnxn, index_col="LoanID")
+
+    return df
+
+
+def get_adj_agg_data(date, cnxn, since=None, shard=None):
+
+    """ pushdown version of get_adj_data + aggregate """
+
+    query = (
+        f"select LoanID, sum(coalesce(OwedAmtAmtPaid, 0)) - sum(coalesce(OwedAmtAmtCharged, 0)) adjamt "
+        f"from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{date}' "
+        f"{since_filter(since)}{shard_filter(shard)}and TransID != 15 and TransID != 4 group by LoanID;"
+    )
+
+    df = read_sql(query, cnxn, index_col="LoanID")
+
+    return df
+
+
+def get_loan_convert_agg_data(loan_ids, date, cnxn, chunksize=LOAN_CONVERT_CHUNKSIZE):
+
+    """ pushdown version of the loan convert extraction and get_trn_agg """
+
+    aggbank = []
+    aggadj = []
+    for in_list in id_chunks(loan_ids, chunksize):
+        bankquery = (
+            f"select LoanID, sum(coalesce(AmtPaid, 0)) - sum(coalesce(AmtCharged, 0)) bankamt "
+            f"from reporting.vw_BankTransactions_transactions where Transdate <= '{date}' "
+            f"and LoanID in ({in_list}) group by LoanID;"
+        )
+        aggbank.append(read_sql(bankquery, cnxn, index_col="LoanID"))
+        adjquery = (
+            f"select LoanID, sum(coalesce(OwedAmtAmtPaid, 0)) - sum(coalesce(OwedAmtAmtCharged, 0)) adjamt "
+            f"from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{date}' "
+            f"and LoanID in ({in_list}) and TransID != 91 and TransID != 97"
+            " and TransID != 34 group by LoanID;"
+        )
+        aggadj.append(read_sql(adjquery, cnxn, index_col="LoanID"))
+
+    if not aggbank:
+        return pd.DataFrame(columns=["AmtPaidTodate"], index=pd.Index([], name="LoanID"))
+
+    return merge_trn_agg(pd.concat(aggbank), pd.concat(aggadj))
+
+
+RUNNING_TOTALS_SPEC = {"bankamt": "sum", "adjamt": "sum", "firstBankTransactionsdate": "min"}
+
+
+def get_running_totals_delta(date, cnxn, since=None):
+
+    """ per loan bank net, adjustment net and first bank transaction date
+        for transactions after since (all history when since is None) """
+
+    aggbank = get_bank_agg_data(date, cnxn, since)
+
+    aggadj = get_adj_agg_data(date, cnxn, since)
+
+    totals = pd.merge(aggbank, aggadj, how="outer", on="LoanID")
+
+    totals["bankamt"] = totals["bankamt"].fillna(0)
+
+    totals["adjamt"] = totals["adjamt"].fillna(0)
+
+    totals["firstBankTransactionsdate"] = pd.to_datetime(totals["firstBankTransactionsdate"])
+
+    return totals
+
+
+def load_running_totals(path):
+
+    """ reading persisted running totals and their watermark, None if there are none yet """
+
+    if not os.path.exists(os.path.join(path, "state.json")):
+        return None, None
+
+    with open(os.path.join(path, "state.json")) as f:
+        state = json.load(f)
+
+    totals = pd.read_parquet(os.path.join(path, "running_totals.parquet"))
+
+    return totals, state
+
+
+def save_running_totals(path, totals, state):
+
+    """ writing running totals first and the watermark last so a failed run
+        leaves the previous watermark in place """
+
+    os.makedirs(path, exist_ok=True)
+
+    totals.to_parquet(os.path.join(path, "running_totals.parquet"))
+
+    with open(os.path.join(path, "state.json"), "w") as f:
+        json.dump(state, f)
+
+
+def reconcile_running_totals(totals, full):
+
+    """ LoanIDs where the incremental totals differ from a full recomputation """
+
+    both = pd.merge(totals, full, how="outer", on="LoanID", suffixes=("", "_full"))
+
+    amt = both[["bankamt", "adjamt"]].fillna(0).values
+
+    amt_full = both[["bankamt_full", "adjamt_full"]].fillna(0).values
+
+    dates = both["firstBankTransactionsdate"]
+
+    dates_full = both["firstBankTransactionsdate_full"]
+
+    date_mismatch = (dates != dates_full) & ~(dates.isna() & dates_full.isna())
+
+    mismatch = ~np.isclose(amt, amt_full).all(axis=1) | date_mismatch
+
+    return both.index[mismatch].to_list()
+
+
+def update_running_totals(date, cnxn, path, rebuild_days=None, reconcile=False):
+
+    """ incremental daily totals: only transactions after the Transdate watermark
+        are read and folded into the persisted per loan totals
+        a full rebuild happens when there is no state, the date moved backwards
+        or the last rebuild is older than rebuild_days """
+
+    totals, state = load_running_totals(path)
+
+    date = pd.to_datetime(date)
+
+    rebuild = (
+        totals is None
+        or date < pd.to_datetime(state["watermark"])
+        or (
+            rebuild_days is not None
+            and (date - pd.to_datetime(state["rebuilt"])).days >= rebuild_days
+        )
+    )
+
+    if rebuild:
+        log.info("rebuilding running totals from full history")
+        totals = get_running_totals_delta(date, cnxn)
+        state = {"watermark": str(date), "rebuilt": str(date)}
+    else:
+        delta = get_running_totals_delta(date, cnxn, since=state["watermark"])
+        log.info(f"folding {len(delta)} loans with transactions after {state['watermark']}")
+        totals = fold_chunks([totals, delta], RUNNING_TOTALS_SPEC)
+        state["watermark"] = str(date)
+
+    if reconcile and not rebuild:
+        full = get_running_totals_delta(date, cnxn)
+        mismatch = reconcile_running_totals(totals, full)
+        if mismatch:
+            log.warning(
+                f"running totals differ from full recomputation for {len(mismatch)} loans, "
+                "using the full recomputation"
+            )
+            totals = full
+            state["rebuilt"] = str(date)
+        else:
+            log.info("running totals reconciled with full recomputation")
+
+    save_running_totals(path, totals, state)
+
+    return totals
+
+
+def running_totals_agg(totals):
+
+    """ splitting running totals into the get_trn_agg and min_BankTransactions_date outputs """
+
+    agg = pd.DataFrame({"AmtPaidTodate": totals["bankamt"] + totals["adjamt"]})
+
+    mindate = totals[["firstBankTransactionsdate"]].dropna()
+
+    return agg, mindate
+
+
+def merge_data(df1, df2, df3):
+
+    """ merging loan and transaction data """
+
+    df = pd.merge(df1, df2, how="left", on="LoanID")
+
+    df = pd.merge(df, df3, how="left", on="LoanID")
+
+    return df
+
+
+def pymnt_start(df):
+
+    """ getting appropriate payment start date """
+
+    df["firstBankTransactionsdate"] = pd.to_datetime(df["firstBankTransactionsdate"])
+
+    return np.where(
+        df["firstBankTransactionsdate"].isna(), df["FirstTransaction"], df["firstBankTransactionsdate"]
+    )
+
+
+def amt_paid(df):
+
+    """ consolidating amt paid for edge cases """
+
+    return np.where(df["AmtPaidTodate"].isna(), 0, df["AmtPaidTodate"])
+
+
+def select_df(df, today):
+
+    """ filtering df for edge cases and active loans """
+
+    df = df[df["Loandate"] <= today]
+
+    df = df[df["DailyPayment"] > 1]
+
+    return df[df["loanBalance"] > 1]
+
+
+def time_passed(df, today):
+
+    """ getting days and weeks passed for each loan,
+    0 for loans not yet started payment or invalid start date """
+
+    df["dayspassed"] = business_days_passed(df, today)
+
+    df["dayspassed"] = np.where(
+        (df["bdstartdate"] > today)
+        | (df["bdstartdate"] < pd.to_datetime("2011-01-01"))
+        | (df["firstBankTransactionsdate"].isna()),
+        0,
+        df["dayspassed"],
+    )
+
+    df["weekspassed"] = weeks_passed(df, today)
+
+    df["weekspassed"] = np.where(
+        (df["bdstartdate"] > today)
+        | (df["bdstartdate"] < pd.to_datetime("2011-01-01"))
+        | (df["firstBankTransactionsdate"].isna()),
+        0,
+        df["weekspassed"],
+    )
+
+    return df
+
+
+def delinquent_amount(df):
+
+    """ calculating amt delinquent """
+
+    df["AmtDelinquent"] = np.where(
+        df["ExpectedAmt"] <= df["AmtOwedAdj"],
+        df["ExpectedAmt"] - df["AmtPaidTodatehack"],
+        df["AmtOwedAdj"] - df["AmtPaidTodatehack"],
+    )
+
+    return np.where(df["AmtDelinquent"] < 0, 0, df["AmtDelinquent"])
+
+
+def get_caldays(df, today):
+
+    """ getting calendar days delinquent """
+
+    df["minutesbehind"] = df["pymnts_delinquent"] * 24 * 60
+
+    df["minutesbehind"] = round(df["minutesbehind"])
+
+    df["minutesbehind"] = np.where(
+        df["minutesbehind"] == np.inf, 1, df["minutesbehind"]
+    )
+
+    df["minutesbehind"] = df["minutesbehind"].astype(int)
+
+    df["datebehind"] = dates_by_subtracting_business_minutes(df["minutesbehind"], today)
+
+    df["CalDays"] = today - df["datebehind"]
+
+    return df["CalDays"] / timedelta(days=1)
+
+
+""" np.timedelta64(1, "M") as pandas converts it, an average Gregorian month """
+
+AVERAGE_MONTH = np.timedelta64(2629746, "s")
+
+
+def loan_term_diff(x, today):
+
+    """ months between loan date and today, works on a scalar or a whole column """
+
+    return (today - x) / AVERAGE_MONTH
+
+
+def get_remain_loan_term(df, today):
+
+    """ calculating the difference in passed loan_term versus full loan_term OR payments left in calendar days
+      to use  when calculating remaining loan_term """
+
+    df["loan_term_diff"] = loan_term_diff(df["Loandate"], today)
+
+    df["amt_left_to_pay"] = df["AmtOwedAdj"] - df["AmtPaidTodatehack"]
+
+    df["paymnts_left"] = df["amt_left_to_pay"] / df["DailyPayment"]
+
+    df["paymnts_left"] = np.where(
+        df["paymnts_left"] < 5,
+        df["paymnts_left"],
+        np.floor(df["paymnts_left"] / 5) * 7 + (df["paymnts_left"] % 5),
+    )
+
+    df["neg_months_convert"] = df["paymnts_left"] / 30
+
+    remaining = df["calcloan_term"] - df["loan_term_diff"]
+
+    df["remaining_term"] = np.where(remaining < 0, df["neg_months_convert"], remaining)
+
+    return df
+
+
+def last_week_days(today):
+
+    """ the amount of days passed in the last week, Monday counts as 1 """
+
+    lastmonday = today - timedelta(days=today.weekday())
+
+    return np.float64((today - lastmonday + timedelta(days=1)).days)
+
+
+def days_in_last_week(df, today):
+
+    """ getting the amount of days passed in the last week """
+
+    df["daysinlastweek"] = last_week_days(today)
+
+    return df
+
+
+def clean_caldays(df, today):
+
+    """ returing # payments delinquent for calendar days behind when
+    the payments are less than the days in this week so far
+    daysinlastweek only depends on today so it is computed once """
+
+    daysinlastweek = last_week_days(today)
+
+    caldays = np.where(
+        df["pymnts_delinquent"] <= daysinlastweek,
+        df["pymnts_delinquent"],
+        df["CalDays"],
+    )
+
+    caldays = np.where(df["pymnts_delinquent"] < 0.001, 0, caldays)
+
+    return np.where(df["minutesbehind"] == 1, np.nan, caldays)
+
+
+def pyment_info(df):
+
+    """ getting the amount of payments expected to date and payments
+    actually paid to date """
+
+    df["pymnts_expected"] = df["dayspassed"].fillna(df["weekspassed"])
+
+    df["pymnts_paid"] = np.where(
+        df["PaymentSchedule"] == "weekly",
+        df["AmtPaidTodatehack"] / (df["DailyPayment"] * 5),
+        df["AmtPaidTodatehack"] / df["DailyPayment"],
+    )
+
+    return df
+
+
+CREDIT_SCORE_BINS = {
+    "edges": [400, 450, 500, 550, 600, 650, 700, 750, 800, 850, 900],
+    "labels": [
+        "400-449",
+        "450-499",
+        "500-549",
+        "550-599",
+        "600-649",
+        "650-699",
+        "700-749",
+        "750-799",
+        "800-849",
+        "850-899",
+    ],
+    "right": False,
+}
+
+""" bin column: source column, edges and labels as pd.cut takes them,
+    and the label used for a missing source value if any """
+
+BIN_SPECS = {
+    "DelinquencyBins": {
+        "column": "CalDays",
+        "edges": [-1, 4, 15, 30, 60, 90, 120, 150, 180, np.inf],
+        "labels": [
+            "0-3",
+            "4-14",
+            "15-29",
+            "30-59",
+            "60-89",
+            "90-119",
+            "120-149",
+            "150-179",
+            "180+",
+        ],
+        "right": False,
+    },
+    "AnnualRevenueBins": {
+        "column": "AnnualRevenue",
+        "edges": [
+            -np.inf,
+            120000,
+            175000,
+            200000,
+            500000,
+            1000000,
+            2000000,
+            5000000,
+            10000000,
+            np.inf,
+        ],
+        "labels": [
+            "0-119K",
+            "120-174K",
+            "175-199K",
+            "200-499K",
+            "500-999K",
+            "1-2M",
+            "2-5M",
+            "5-10M",
+            ">=10M",
+        ],
+        "right": False,
+        "missing": "No Rev Info",
+    },
+    "AnnualRevenueBins2": {
+        "column": "AnnualRevenue",
+        "edges": [-np.inf, 175000, 200000, np.inf],
+        "labels": ["0-174K", "175-199K", "200K+"],
+        "right": False,
+        "missing": "No Rev Info",
+    },
+    "YIBbins": {
+        "column": "YearsInBusiness",
+        "edges": [
+            -np.inf,
+            0,
+            1,
+            2,
+            3,
+            4,
+            5,
+            6,
+            7,
+            8,
+            9,
+            14,
+            19,
+            24,
+            29,
+            34,
+            39,
+            44,
+            49,
+            99,
+            np.inf,
+        ],
+        "labels": [
+            "0",
+            "1",
+            "2",
+            "3",
+            "4",
+            "5",
+            "6",
+            "7",
+            "8",
+            "9",
+            "10-14",
+            "15-19",
+            "20-24",
+            "25-29",
+            "30-34",
+            "35-39",
+            "40-44",
+            "45-49",
+            "50-99",
+            "100+",
+        ],
+        "right": True,
+        "missing": "No Info",
+    },
+    "CreditScorebins": dict(CREDIT_SCORE_BINS, column="CreditScore"),
+    "CreditScore2bins": dict(CREDIT_SCORE_BINS, column="CreditScore2"),
+}
+
+
+def compile_bins(specs):
+
+    """ edges as arrays and one categorical dtype per distinct label set,
+        so bin columns with the same labels share their dictionary """
+
+    dtypes = {}
+    compiled = {}
+    for name, spec in specs.items():
+        categories = tuple(spec["labels"]) + ((spec["missing"],) if "missing" in spec else ())
+        if categories not in dtypes:
+            dtypes[categories] = pd.CategoricalDtype(list(categories), ordered=True)
+        compiled[name] = {
+            "column": spec["column"],
+            "edges": np.asarray(spec["edges"], dtype=float),
+            "side": "left" if spec["right"] else "right",
+            "missing": len(spec["labels"]) if "missing" in spec else -1,
+            "dtype": dtypes[categories],
+        }
+    return compiled
+
+
+BINS = compile_bins(BIN_SPECS)
+
+
+def bin_codes(x, edges, side):
+
+    """ pd.cut codes via np.searchsorted, -1 outside the edges """
+
+    ids = np.searchsorted(edges, x, side=side)
+
+    return np.where(np.isnan(x) | (ids == 0) | (ids == len(edges)), -1, ids - 1)
+
+
+def bins(df, specs=BINS):
+
+    """ binning vars of analysis into compact categoricals in one pass over the bin specs,
+        missing source values get the spec's missing category """
+
+    for name, spec in specs.items():
+        x = np.asarray(df[spec["column"]], dtype=float)
+        codes = bin_codes(x, spec["edges"], spec["side"])
+        codes = np.where(np.isnan(x), spec["missing"], codes)
+        df[name] = pd.Categorical.from_codes(codes, dtype=spec["dtype"])
+
+    return df
+
+
+def data_cleaning(df):
+
+    df["calandar_days"] = np.where(
+        df["calandar_days"] == np.inf, np.nan, df["calandar_days"]
+    )
+
+    df["delinquent_payments"] = np.where(
+        df["delinquent_payments"] == np.inf, np.nan, df["delinquent_payments"]
+    )
+
+    df["expected_payments"] = np.where(
+        df["expected_payments"] == np.inf, np.nan, df["expected_payments"]
+    )
+
+    df["paid_payments"] = np.where(
+        df["paid_payments"] == np.inf, np.nan, df["paid_payments"]
+    )
+
+    return df
+
+
+""" special payment schedules, one row per schedule segment
+    expected amount = base + the segments up to x + rate * (x - breakpoint) on the segment x falls in,
+    x is dayspassed for unit days, or weeks since anchor (inclusive) for unit weeks
+    the first and last segments extend past their breakpoints """
+
+EXPECTED_AMT_OVERRIDES = pd.DataFrame.from_dict(
+    {
+        "LoanID": [27, 99, 56, 56],
+        "unit": ["weeks", "days", "days", "days"],
+        "anchor": pd.to_datetime(["2020-07-15", None, None, None]),
+        "base": [50600, 55 * 213, 0, 0],
+        "breakpoint": [0, 55, 0, 103],
+        "rate": [4500, 700, 200, 500],
+    }
+)
+
+
+def load_overrides(path):
+
+    """ reading an override table with the EXPECTED_AMT_OVERRIDES columns from csv """
+
+    return pd.read_csv(path, parse_dates=["anchor"])
+
+
+def override_segments(overrides):
+
+    """ per segment start amount and next breakpoint so each segment is evaluated on its own """
+
+    seg = overrides.sort_values(["LoanID", "breakpoint"]).reset_index(drop=True)
+
+    loan = seg.groupby("LoanID")
+
+    seg["next_breakpoint"] = loan["breakpoint"].shift(-1)
+
+    full = ((seg["next_breakpoint"] - seg["breakpoint"]) * seg["rate"]).fillna(0)
+
+    seg["start_amt"] = seg["base"] + full.groupby(seg["LoanID"]).cumsum() - full
+
+    seg["first"] = loan.cumcount() == 0
+
+    seg["last"] = seg["next_breakpoint"].isna()
+
+    return seg
+
+
+def override_expectedamt(df, today, overrides=EXPECTED_AMT_OVERRIDES):
+
+    """ expected amounts for loans in the override table by a vectorized join and
+        piecewise evaluation, NaN for loans not in the table """
+
+    seg = override_segments(overrides)
+
+    rows = df[["LoanID", "dayspassed"]].reset_index().merge(seg, on="LoanID")
+
+    weeks = weeks_elapsed(rows["anchor"], today)
+
+    rows["x"] = np.where(rows["unit"] == "weeks", weeks, rows["dayspassed"])
+
+    active = ((rows["x"] >= rows["breakpoint"]) | rows["first"]) & (
+        (rows["x"] < rows["next_breakpoint"]) | rows["last"]
+    )
+
+    rows = rows[active]
+
+    amt = rows["start_amt"] + rows["rate"] * (rows["x"] - rows["breakpoint"])
+
+    return pd.Series(amt.values, index=rows["index"].values).reindex(df.index)
+
+
+def expected_amount(df):
+
+    """ vectorized expectedamt """
+
+    return np.where(
+        df["DailyPayment"] == 0,
+        np.nan,
+        np.where(
+            df["PaymentSchedule"] == "weekly",
+            df["DailyPayment"] * 5 * df["weekspassed"],
+            df["DailyPayment"] * df["dayspassed"],
         ),
     )
 
-    df["AnnualRevenueBins2"] = np.where(
-        df.AnnualRevenue.isnull(),
-        "No Rev Info",
-        pd.cut(
-            df["AnnualRevenue"],
-            [-np.inf, 175000, 200000, np.inf],
-            labels=["0-174K", "175-199K", "200K+"],
-            right=False,
-        ),
+
+def expectedamt_cleaning(df, today, overrides=EXPECTED_AMT_OVERRIDES):
+
+    """ special schedules from the override table
+    and making sure expected amount doesn't exceed amount owed """
+
+    df["ExpectedAmt"] = np.where(
+        df["LoanID"].isin(overrides["LoanID"]),
+        override_expectedamt(df, today, overrides),
+        df["ExpectedAmt"],
+    )
+
+    df["ExpectedAmt"] = np.where(
+        df["ExpectedAmt"] > df["AmtOwedAdj"], df["AmtOwedAdj"], df["ExpectedAmt"]
+    )
+
+    return df
+
+
+""" the uploaded columns, internal name to warehouse name in table order """
+
+OUTPUT_COLUMNS = {
+    "LoanID": "loan_id",
+    "BusinessID": "first_BusinessID",
+    "Loandate": "loan_date",
+    "FirstTransaction": "first_trans",
+    "firstBankTransactionsdate": "first_BankTransactions_date",
+    "loanAmt": "loan_amt",
+    "calcloan_term": "loan_term",
+    "AmtOwed": "loan_OwedAmt",
+    "CarriedOverBal": "fwded_bal",
+    "RefinancingFee": "fee",
+    "AmtOwedFwded": "OwedAmt_balance_tofwd",
+    "AmtOwedAdj": "AmtOwedAdj",
+    "AmtPaidTodatehack": "paid_amt_to_date",
+    "loanBalance": "loan_balance",
+    "DailyPayment": "daily_payment",
+    "dayspassed": "days",
+    "weekspassed": "weeks",
+    "ExpectedAmt": "expected_amount",
+    "AmtDelinquent": "amt_deliquent",
+    "CalDays": "calandar_days",
+    "pymnts_delinquent": "delinquent_payments",
+    "PaymentSchedule": "payment_type",
+    "DelinquencyBins": "bins_delinquency",
+    "AnnualRevenueBins": "revenue_bins",
+    "AnnualRevenueBins2": "revenue_bins2",
+    "YIBbins": "years_in_business_bins",
+    "CreditScorebins": "CreditScore_bins",
+    "CreditScore2bins": "CreditScore2_bins",
+    "CreditScore": "CreditScore",
+    "CreditScore2": "CreditScore2",
+    "YearsInBusiness": "years_in_business",
+    "AnnualRevenue": "revenue",
+    "AppType": "application_type",
+    "industry1": "industry1",
+    "industry2": "industry2",
+    "industry3": "industry3",
+    "industry4": "industry4",
+    "RepType": "representative_type",
+    "date": "date",
+    "remaining_term": "remaining_term",
+    "pymnts_expected": "expected_payments",
+    "pymnts_paid": "paid_payments",
+}
+
+
+def remove_and_rename(df):
+
+    """ removing extraneous columns """
+
+    df = df[list(OUTPUT_COLUMNS)]
+
+    df.columns = list(OUTPUT_COLUMNS.values())
+
+    return df
+
+
+def loan_balance(df):
+
+    """ getting balanc """
+
+    return df["AmtOwedAdj"] - df["AmtPaidTodatehack"]
+
+
+def get_pymnts_delinquent(df):
+
+    return df["AmtDelinquent"] / df["DailyPayment"]
+
+
+def get_date():
+
+    """ for historical data uploads, replacing analysis date with
+    first of the month date """
+
+    date = datetime.today().replace(day=1)
+
+    date = date.strftime("%Y-%m-%d")
+
+    return pd.to_datetime(date)
+
+
+def date_var(upload_type):
+
+    if upload_type == "daily":
+        return get_today()
+    elif upload_type == "historical":
+        return get_date()
+
+
+""" per stage metrics of the run, appended by timed and written by write_run_report,
+    the tracemalloc peak is only recorded while tracemalloc is tracing (--trace-memory),
+    the source queries run concurrently so their cpu time and memory peaks overlap,
+    backfills and sharded runs tag each metric with its date or shard """
+
+STAGE_METRICS = []
+
+STAGE_TAGS = {}
+
+PROFILE_STAGE = None
+
+PROFILE_DIR = "."
+
+
+def frame_rows(x):
+
+    """ rows of a frame, or of the first frame in a tuple, None for anything else """
+
+    if isinstance(x, tuple):
+        x = next((item for item in x if isinstance(item, pd.DataFrame)), None)
+
+    return len(x) if isinstance(x, pd.DataFrame) else None
+
+
+def peak_rss_mb():
+
+    """ peak resident set size of the process so far, ru_maxrss is in KB on linux """
+
+    if resource is None:
+        return None
+
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+@contextmanager
+def stage_tags(**tags):
+
+    """ adding tags, e.g. the backfill date or the shard, to the metrics of the stages run inside """
+
+    previous = dict(STAGE_TAGS)
+
+    STAGE_TAGS.update(tags)
+
+    try:
+        yield
+    finally:
+        STAGE_TAGS.clear()
+        STAGE_TAGS.update(previous)
+
+
+def timed(name, func, *args, **kwargs):
+
+    """ running one stage and recording wall and cpu seconds, rows in and out,
+        the tracemalloc peak over the stage and the process peak RSS,
+        the stage named PROFILE_STAGE runs under cProfile and is dumped to PROFILE_DIR """
+
+    rows_in = [len(arg) for arg in args if isinstance(arg, pd.DataFrame)]
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        traced_start = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    if name == PROFILE_STAGE:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args, **kwargs)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.prof"))
+    else:
+        result = func(*args, **kwargs)
+
+    metrics = {
+        "stage": name,
+        **STAGE_TAGS,
+        "wall_s": round(time.perf_counter() - start, 4),
+        "cpu_s": round(time.process_time() - cpu_start, 4),
+        "rows_in": rows_in[0] if rows_in else None,
+        "rows_out": frame_rows(result),
+        "traced_peak_mb": round((tracemalloc.get_traced_memory()[1] - traced_start) / 1e6, 2)
+        if tracing
+        else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    STAGE_METRICS.append(metrics)
+
+    log.info(f"{name} complete, {metrics['wall_s']:.2f}s", **metrics)
+
+    return result
+
+
+def write_run_report(path, **run):
+
+    """ writing the run details and its stage metrics to a json report """
+
+    with open(path, "w") as f:
+        json.dump(dict(run, stages=STAGE_METRICS), f, indent=2, default=str)
+
+
+def base_frame(activefunds, agg, mindate, today):
+
+    """ merging loans with their aggregated transactions, deriving payment start,
+    amt paid to date and loanBalance and filtering to currently active loans """
+
+    """ merging datasets to main df """
+
+    df = merge_data(activefunds, agg, mindate)
+
+    log.info("dataset merge complete, " f"{df.shape[0]} rows, {df.shape[1]} columns")
+
+    """ getting payment start date """
+
+    df["bdstartdate"] = pymnt_start(df)
+
+    """ consolidating amt paid to date with edge cases """
+
+    df["AmtPaidTodatehack"] = amt_paid(df)
+
+    """ calculating loanBalance to date """
+
+    df["loanBalance"] = loan_balance(df)
+
+    log.info(
+        "loan balance calculation complete, "
+        f"{df.shape[0]} rows, {df.shape[1]} columns"
+    )
+
+    """ filtering out any edge cases with data errors and selecting currently active loans """
+
+    df = select_df(df, today)
+
+    log.info(
+        "edge case filtering complete, " f"{df.shape[0]} rows, {df.shape[1]} columns"
+    )
+
+    return df
+
+
+""" polars backend, the pandas functions above stay the reference
+    each function takes and returns pandas frames like its reference so the backends are interchangeable,
+    polars runs the groupbys, joins and filters multi threaded on all cores """
+
+
+def pl_frame(df):
+
+    """ a pandas frame as polars, a LoanID index becomes a column and LoanID is Int64
+        so join keys match whichever extraction the frames came from """
+
+    if df.index.name == "LoanID":
+        df = df.reset_index()
+
+    return pl.from_pandas(df).with_columns(pl.col("LoanID").cast(pl.Int64))
+
+
+def pl_aggregate(df, credit, debit, varname):
+
+    """ aggregate on a polars frame """
+
+    return df.group_by("LoanID").agg(
+        (pl.col(credit).cast(pl.Float64).sum() - pl.col(debit).cast(pl.Float64).sum()).alias(varname)
+    )
+
+
+def pl_get_trn_agg(bank, adj):
+
+    """ get_trn_agg on polars """
+
+    aggbank = pl_aggregate(
+        pl_frame(bank[["LoanID", "AmtPaid", "AmtCharged"]]), "AmtPaid", "AmtCharged", "bankamt"
+    )
+
+    aggadj = pl_aggregate(
+        pl_frame(adj[["LoanID", "OwedAmtAmtPaid", "OwedAmtAmtCharged"]]),
+        "OwedAmtAmtPaid",
+        "OwedAmtAmtCharged",
+        "adjamt",
+    )
+
+    agg = aggbank.join(aggadj, on="LoanID", how="full", coalesce=True).select(
+        "LoanID",
+        (pl.col("bankamt").fill_null(0) + pl.col("adjamt").fill_null(0)).alias("AmtPaidTodate"),
+    )
+
+    return agg.sort("LoanID").to_pandas().set_index("LoanID")
+
+
+def pl_min_BankTransactions_date(df):
+
+    """ min_BankTransactions_date on polars """
+
+    mindate = pl_frame(df[["LoanID", "Transdate"]]).group_by("LoanID").agg(
+        pl.col("Transdate").min().alias("firstBankTransactionsdate")
+    )
+
+    return mindate.sort("LoanID").to_pandas().set_index("LoanID")
+
+
+def pl_base_frame(activefunds, agg, mindate, today):
+
+    """ base_frame as one lazy polars query """
+
+    today = pd.Timestamp(today).to_pydatetime()
+
+    df = (
+        pl_frame(activefunds)
+        .lazy()
+        .join(pl_frame(agg).lazy(), on="LoanID", how="left", maintain_order="left")
+        .join(pl_frame(mindate).lazy(), on="LoanID", how="left", maintain_order="left")
+        .with_columns(
+            pl.coalesce("firstBankTransactionsdate", "FirstTransaction").alias("bdstartdate"),
+            pl.col("AmtPaidTodate").cast(pl.Float64).fill_null(0).alias("AmtPaidTodatehack"),
+        )
+        .with_columns((pl.col("AmtOwedAdj") - pl.col("AmtPaidTodatehack")).alias("loanBalance"))
+        .filter(
+            (pl.col("Loandate") <= today)
+            & (pl.col("DailyPayment") > 1)
+            & (pl.col("loanBalance") > 1)
+        )
+        .collect()
+        .to_pandas()
+    )
+
+    log.info(
+        "base frame complete, " f"{df.shape[0]} rows, {df.shape[1]} columns"
+    )
+
+    return df
+
+
+BACKENDS = {
+    "pandas": {
+        "get_trn_agg": get_trn_agg,
+        "min_BankTransactions_date": min_BankTransactions_date,
+        "base_frame": base_frame,
+    },
+    "polars": {
+        "get_trn_agg": pl_get_trn_agg,
+        "min_BankTransactions_date": pl_min_BankTransactions_date,
+        "base_frame": pl_base_frame,
+    },
+}
+
+
+def get_backend(name):
+
+    """ the transformation functions of a backend, polars is an optional dependency """
+
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name}, expected one of {list(BACKENDS)}")
+
+    if name == "polars" and pl is None:
+        raise ImportError("the polars backend needs polars installed")
+
+    return BACKENDS[name]
+
+
+""" the frame every stage starts from, merged loans and transactions filtered to active loans """
+
+BASE_COLUMNS = [
+    "LoanID",
+    "Loandate",
+    "FirstTransaction",
+    "firstBankTransactionsdate",
+    "AmtPaidTodate",
+    "AmtOwedAdj",
+    "DailyPayment",
+    "PaymentSchedule",
+    "bdstartdate",
+    "AmtPaidTodatehack",
+    "loanBalance",
+]
+
+
+def stage_time_passed(df, params):
+    return time_passed(df, params["today"])
+
+
+def stage_expected_amount(df, params):
+
+    """ calculating expected amount, correcting for expected amt exceeds AmtOwedAdj """
+
+    df["ExpectedAmt"] = expected_amount(df)
+
+    return expectedamt_cleaning(df, params["today"], params["overrides"])
+
+
+def stage_delinquent(df, params):
+
+    """ calculating payments delinquent, AmtDelinquent is the unclipped amount
+    delinquent_amount leaves on the frame """
+
+    df["AmtDeliquent"] = delinquent_amount(df)
+
+    df["pymnts_delinquent"] = get_pymnts_delinquent(df)
+
+    return df
+
+
+def stage_caldays(df, params):
+
+    """ conversion of payments behind (business days behind) to minutes and getting decimal value
+    for calendar days behind, then calendar days = payments delinquent when payments are only
+    delinquent in the week of analysis """
+
+    df["CalDays"] = get_caldays(df, params["today"])
+
+    df["CalDays"] = clean_caldays(df, params["today"])
+
+    return df
+
+
+def stage_pyment_info(df, params):
+    return pyment_info(df)
+
+
+def stage_remain_loan_term(df, params):
+    return get_remain_loan_term(df, params["today"])
+
+
+def stage_date(df, params):
+
+    """ creating date of analysis variable for record keeping as data becomes historical """
+
+    df["date"] = params["date"]
+
+    return df
+
+
+def bin_stage(name, spec):
+
+    """ one stage per bin column so a bin only pulls in its own source column """
+
+    def stage_bin(df, params):
+        return bins(df, {name: spec})
+
+    return {"name": name, "inputs": [spec["column"]], "outputs": [name], "func": stage_bin}
+
+
+""" the derived columns as named stages with the columns they read and the columns they keep,
+    intermediates a stage writes that are not outputs are dropped once no later stage reads them """
+
+STAGES = [
+    {
+        "name": "time_passed",
+        "inputs": ["bdstartdate", "firstBankTransactionsdate", "PaymentSchedule"],
+        "outputs": ["dayspassed", "weekspassed"],
+        "func": stage_time_passed,
+    },
+    {
+        "name": "expected_amount",
+        "inputs": [
+            "LoanID",
+            "DailyPayment",
+            "PaymentSchedule",
+            "dayspassed",
+            "weekspassed",
+            "AmtOwedAdj",
+        ],
+        "outputs": ["ExpectedAmt"],
+        "func": stage_expected_amount,
+    },
+    {
+        "name": "delinquent",
+        "inputs": ["ExpectedAmt", "AmtOwedAdj", "AmtPaidTodatehack", "DailyPayment"],
+        "outputs": ["AmtDelinquent", "pymnts_delinquent"],
+        "func": stage_delinquent,
+    },
+    {
+        "name": "caldays",
+        "inputs": ["pymnts_delinquent"],
+        "outputs": ["CalDays"],
+        "func": stage_caldays,
+    },
+    {
+        "name": "pyment_info",
+        "inputs": [
+            "dayspassed",
+            "weekspassed",
+            "PaymentSchedule",
+            "AmtPaidTodatehack",
+            "DailyPayment",
+        ],
+        "outputs": ["pymnts_expected", "pymnts_paid"],
+        "func": stage_pyment_info,
+    },
+    {
+        "name": "remaining_term",
+        "inputs": [
+            "Loandate",
+            "AmtOwedAdj",
+            "AmtPaidTodatehack",
+            "DailyPayment",
+            "calcloan_term",
+        ],
+        "outputs": ["remaining_term"],
+        "func": stage_remain_loan_term,
+    },
+    {"name": "date", "inputs": [], "outputs": ["date"], "func": stage_date},
+] + [bin_stage(name, spec) for name, spec in BINS.items()]
+
+
+def stage_plan(outputs, stages=STAGES):
+
+    """ the stages the outputs need in dependency order, each stage once,
+        columns no stage produces come from the base frame """
+
+    producers = {column: stage for stage in stages for column in stage["outputs"]}
+
+    plan = []
+    planned = set()
+
+    def visit(column):
+        stage = producers.get(column)
+        if stage is None or stage["name"] in planned:
+            return
+        planned.add(stage["name"])
+        for input_column in stage["inputs"]:
+            visit(input_column)
+        plan.append(stage)
+
+    for column in outputs:
+        visit(column)
+
+    return plan
+
+
+def stage_columns(outputs, stages=STAGES):
+
+    """ every column the outputs need from the base frame or a stage """
+
+    columns = set(outputs)
+    for stage in stage_plan(outputs, stages):
+        columns.update(stage["inputs"])
+    return columns
+
+
+def run_stages(df, outputs, params, stages=STAGES):
+
+    """ running only the stages the outputs need, before each stage dropping the columns
+        neither it nor a later stage reads, returns the outputs in order """
+
+    outputs = list(outputs)
+
+    plan = stage_plan(outputs, stages)
+
+    for i, stage in enumerate(plan):
+        needed = set(outputs).union(*(later["inputs"] for later in plan[i:]))
+        unneeded = [column for column in df.columns if column not in needed]
+        if unneeded:
+            df = df.drop(columns=unneeded)
+
+        df = timed(stage["name"], stage["func"], df, params)
+
+        log.info(
+            f"{stage['name']} stage complete, "
+            f"{df.shape[0]} rows, {df.shape[1]} columns"
+        )
+
+    return df[outputs]
+
+
+def query_fingerprint(func, args):
+
+    """ hash of the extraction function source (and so its query text) and its plain arguments """
+
+    fingerprint = hashlib.sha1(inspect.getsource(func).encode())
+
+    for arg in args:
+        if isinstance(arg, (str, int, float, list, tuple, datetime, date)):
+            fingerprint.update(repr(arg).encode())
+
+    return fingerprint.hexdigest()[:12]
+
+
+def write_parquet(df, path):
+
+    """ writing to a temp file first so a killed run never leaves a partial snapshot """
+
+    df.to_parquet(path + ".tmp")
+
+    os.replace(path + ".tmp", path)
+
+
+def cached(cache, refresh, name, date, func, *args):
+
+    """ snapshot cache of an extracted frame (or tuple of frames) keyed by
+        analysis date and query fingerprint, reloaded with memory mapped reads
+        refresh re-runs the query and overwrites the snapshot """
+
+    if not cache:
+        return func(*args)
+
+    folder = os.path.join(cache, pd.to_datetime(date).strftime("%Y-%m-%d"))
+
+    base = os.path.join(folder, f"{name}-{query_fingerprint(func, args)}")
+
+    if not refresh and os.path.exists(base + ".parquet"):
+        log.info(f"{name} loaded from cache")
+        return pd.read_parquet(base + ".parquet", memory_map=True)
+
+    if not refresh and os.path.exists(base + ".0.parquet"):
+        log.info(f"{name} loaded from cache")
+        parts = []
+        while os.path.exists(f"{base}.{len(parts)}.parquet"):
+            parts.append(pd.read_parquet(f"{base}.{len(parts)}.parquet", memory_map=True))
+        return tuple(parts)
+
+    result = func(*args)
+
+    os.makedirs(folder, exist_ok=True)
+
+    if isinstance(result, tuple):
+        for i, part in enumerate(result):
+            write_parquet(part, f"{base}.{i}.parquet")
+    else:
+        write_parquet(result, base + ".parquet")
+
+    return result
+
+
+def evict_cache(cache, max_bytes=None, max_age_days=None):
+
+    """ removing snapshots older than max_age_days, then the oldest ones
+        until the cache is under max_bytes """
+
+    if not cache or not os.path.isdir(cache):
+        return
+
+    files = []
+    for root, _, names in os.walk(cache):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    files.sort()
+
+    now = time.time()
+
+    total = sum(size for _, size, _ in files)
+
+    for mtime, size, path in files:
+        expired = max_age_days is not None and now - mtime > max_age_days * 86400
+        oversized = max_bytes is not None and total > max_bytes
+        if not (expired or oversized):
+            continue
+        os.remove(path)
+        total -= size
+
+    for root, dirs, names in os.walk(cache, topdown=False):
+        if root != cache and not dirs and not names:
+            os.rmdir(root)
+
+
+EXTRACT_WORKERS = 4
+
+
+def extract_sources(
+    today,
+    cnxn,
+    pushdown=False,
+    chunksize=None,
+    workers=EXTRACT_WORKERS,
+    incremental=None,
+    rebuild_days=None,
+    reconcile=False,
+    cache=None,
+    refresh=False,
+    shard=None,
+):
+
+    """ running the independent source queries on a thread pool,
+        cnxn should be an engine with a pool of at least workers connections
+        in incremental mode bank holds the running totals and there is no adj
+        shard limits the loans and transactions to one BusinessID shard """
+
+    if incremental and shard is not None:
+        raise ValueError("incremental mode can't be combined with sharding")
+
+    if incremental:
+        bank = (update_running_totals, today, cnxn, incremental, rebuild_days, reconcile)
+        adj = None
+    elif pushdown:
+        bank = (get_bank_agg_data, today, cnxn, None, shard)
+        adj = (get_adj_agg_data, today, cnxn, None, shard)
+    elif chunksize:
+        bank = (stream_bank_agg, today, cnxn, chunksize, shard)
+        adj = (stream_adj_agg, today, cnxn, chunksize, shard)
+    else:
+        bank = (get_bank_data, today, cnxn, None, shard)
+        adj = (get_adj_data, today, cnxn, None, shard)
+
+    queries = {
+        "active_loans": (active_loans, today, cnxn, shard),
+        "bank": bank,
+        "adj": adj,
+        "loan_convert": (get_loan_convert_loans, cnxn),
+    }
+
+    queries = {name: query for name, query in queries.items() if query is not None}
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            name: pool.submit(timed, name, cached, cache, refresh, name, today, *query)
+            for name, query in queries.items()
+        }
+        sources = {name: future.result() for name, future in futures.items()}
+
+    log.info(f"source extraction complete, {time.perf_counter() - start:.2f}s")
+
+    return sources
+
+
+BULK_BATCH_SIZE = 10000
+
+
+def bulk_records(df):
+
+    """ rows as dicts of python values for executemany,
+        NaN and NaT as None and datetimes as datetime.datetime """
+
+    values = df.astype(object).where(df.notna(), None)
+
+    for column in df.select_dtypes("datetime").columns:
+        dates = np.asarray(df[column].dt.to_pydatetime(), dtype=object)
+
+        values[column] = pd.Series(
+            np.where(df[column].notna().values, dates, None), index=df.index, dtype=object
+        )
+
+    return values.to_dict("records")
+
+
+""" postgres drivers with a COPY api, psycopg2's copy_expert or psycopg 3's cursor.copy,
+    other postgres drivers take the executemany path """
+
+COPY_DRIVERS = ["psycopg2", "psycopg"]
+
+
+def copy_batches(cursor, df, table, schema, batch_size, driver="psycopg2"):
+
+    """ postgres COPY of df in csv batches """
+
+    columns = ", ".join(f'"{column}"' for column in df.columns)
+
+    query = f"copy {schema}.{table} ({columns}) from stdin with csv"
+
+    for i in range(0, len(df), batch_size):
+        buffer = io.StringIO()
+        df.iloc[i : i + batch_size].to_csv(buffer, index=False, header=False)
+        if driver == "psycopg":
+            with cursor.copy(query) as copy:
+                copy.write(buffer.getvalue())
+        else:
+            buffer.seek(0)
+            cursor.copy_expert(query, buffer)
+
+
+def bulk_load(session, df, table, schema="reports", batch_size=BULK_BATCH_SIZE):
+
+    """ loading df into schema.table in batches inside the session's transaction,
+        COPY on postgres with a COPY_DRIVERS driver, otherwise one executemany per batch against the reflected table
+        which pyodbc runs as a bulk parameter array when the engine has fast_executemany set """
+
+    conn = session.connection()
+
+    start = time.perf_counter()
+
+    if conn.dialect.name == "postgresql" and conn.dialect.driver in COPY_DRIVERS:
+        cursor = conn.connection.cursor()
+        try:
+            copy_batches(cursor, df, table, schema, batch_size, conn.dialect.driver)
+        finally:
+            cursor.close()
+    else:
+        target = sq.Table(table, sq.MetaData(), schema=schema, autoload_with=conn)
+        for i in range(0, len(df), batch_size):
+            conn.execute(target.insert(), bulk_records(df.iloc[i : i + batch_size]))
+
+    elapsed = time.perf_counter() - start
+
+    log.info(
+        f"bulk loaded {len(df)} records in {elapsed:.2f}s, "
+        f"{len(df) / elapsed if elapsed else 0:.0f} rows/s"
+    )
+
+    return len(df)
+
+
+def staging_table(session, model):
+
+    """ a table named <table>_staging in the same schema with the model's columns, created if missing,
+        indexes and constraints are left out so their names don't clash with the model's table """
+
+    target = model.__table__
+
+    staging = sq.Table(
+        f"{target.name}_staging",
+        sq.MetaData(),
+        *[sq.Column(column.name, column.type) for column in target.columns],
+        schema=target.schema,
+    )
+
+    staging.create(session.connection(), checkfirst=True)
+
+    return staging
+
+
+def publish_partition(session, df, model, cleardate, batch_size=BULK_BATCH_SIZE):
+
+    """ loading df into the staging table in batches, then swapping the date partition into
+        the model's table with a set based delete and insert select in one transaction,
+        readers see the previous rows for the date until the commit and never a partial load """
+
+    staging = staging_table(session, model)
+
+    target = model.__table__
+
+    try:
+        session.execute(staging.delete().where(staging.c.date == cleardate))
+        bulk_load(session, df, staging.name, staging.schema, batch_size)
+        session.commit()
+
+        start = time.perf_counter()
+
+        session.execute(target.delete().where(target.c.date == cleardate))
+        session.execute(
+            target.insert().from_select(
+                list(df.columns),
+                sq.select(*[staging.c[column] for column in df.columns]).where(
+                    staging.c.date == cleardate
+                ),
+            )
+        )
+        session.execute(staging.delete().where(staging.c.date == cleardate))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    log.info(
+        f"published {len(df)} records to {target.name} for {cleardate}, "
+        f"swap {time.perf_counter() - start:.2f}s"
+    )
+
+    return len(df)
+
+
+def finish_df(df, loan_convert_agg, outputs, params):
+
+    """ replacing amt paid to date of loan convert loans and running the stages for the outputs """
+
+    df = pd.merge(df, loan_convert_agg, how="left", on="LoanID")
+
+    log.info("dataset merge complete, " f"{df.shape[0]} rows, {df.shape[1]} columns")
+
+    df["AmtPaidTodatehack"] = df["AmtPaidTodate_y"].fillna(df["AmtPaidTodatehack"])
+
+    df["PaymentSchedule"] = df["PaymentSchedule"].str.lower().astype("category")
+
+    return run_stages(df, outputs, params)
+
+
+def compute_df(
+    db_connection,
+    today,
+    outputs=OUTPUT_COLUMNS,
+    date=None,
+    pushdown=False,
+    chunksize=None,
+    workers=EXTRACT_WORKERS,
+    incremental=None,
+    rebuild_days=None,
+    reconcile=False,
+    cache=None,
+    refresh=False,
+    overrides=EXPECTED_AMT_OVERRIDES,
+    backend="pandas",
+    shard=None,
+):
+
+    """ loading and merging the sources as of today and running the stages the outputs need,
+        outputs are internal column names, e.g. just the bins or balances for an ad hoc report,
+        date is the date of analysis column and defaults to today,
+        backend picks the implementation of the transaction aggregation and base frame,
+        shard (index, count) computes only the loans of one BusinessID shard """
+
+    outputs = list(outputs)
+
+    columns = stage_columns(outputs).union(BASE_COLUMNS)
+
+    ops = get_backend(backend)
+
+    """ loading in data, the source queries only depend on today so they run concurrently """
+
+    sources = extract_sources(
+        today,
+        db_connection,
+        pushdown,
+        chunksize,
+        workers,
+        incremental,
+        rebuild_days,
+        reconcile,
+        cache,
+        refresh,
+        shard,
+    )
+
+    activefunds = timed("transform_active_loans", transform_active_loans, sources["active_loans"])
+
+    activefunds = activefunds[[column for column in activefunds.columns if column in columns]]
+
+    """ aggregating BankTransactions and AdjustmentTransactions data and combining them to get amt paid to date
+        incremental folds new transactions into persisted running totals,
+        pushdown lets the database do the sums, chunksize folds the raw rows chunk by chunk,
+        otherwise BankTransactions is read once for both the first transaction date and amt paid """
+
+    if incremental:
+        agg, BankTransactionsmindate = running_totals_agg(sources["bank"])
+    elif pushdown:
+        aggbank = sources["bank"]
+
+        BankTransactionsmindate = aggbank[["firstBankTransactionsdate"]]
+
+        agg = merge_trn_agg(aggbank[["bankamt"]], sources["adj"])
+    elif chunksize:
+        aggbank, BankTransactionsmindate = sources["bank"]
+
+        agg = merge_trn_agg(aggbank, sources["adj"])
+    else:
+        bank = sources["bank"]
+
+        BankTransactionsmindate = timed("min_BankTransactions_date", ops["min_BankTransactions_date"], bank)
+
+        bank = get_paid_bank(bank)
+
+        adj = get_paid_adj(sources["adj"])
+
+        agg = timed("get_trn_agg", ops["get_trn_agg"], bank, adj)
+
+    log.info(
+        "data aggregation complete, " f"{agg.shape[0]} rows, {agg.shape[1]} columns"
+    )
+
+    log.info(
+        "data loading complete, "
+        f"{activefunds.shape[0]} rows, {activefunds.shape[1]} columns"
+    )
+
+    """ merging datasets to main df and selecting currently active loans """
+
+    df = timed("base_frame", ops["base_frame"], activefunds, agg, BankTransactionsmindate, today)
+
+    """ special calculations for loans with a certain transaction type to exclude it """
+
+    loan_convert = pd.merge(df, sources["loan_convert"], how="inner", on="LoanID")
+
+    loan_convert_id = loan_convert["LoanID"].drop_duplicates().to_list()
+
+    if pushdown:
+        loan_convert_agg = timed(
+            "loan_convert_agg",
+            cached,
+            cache,
+            refresh,
+            "loan_convert_agg",
+            today,
+            get_loan_convert_agg_data,
+            loan_convert_id,
+            today,
+            db_connection,
+        )
+    else:
+        loan_convert_bank = timed(
+            "loan_convert_bank",
+            cached,
+            cache,
+            refresh,
+            "loan_convert_bank",
+            today,
+            get_loan_convert_bank_data,
+            loan_convert_id,
+            today,
+            db_connection,
+        )
+
+        loan_convert_bank = get_paid_bank(loan_convert_bank)
+
+        log.info(
+            "loan convert transactions complete, "
+            f"{loan_convert_bank.shape[0]} rows, {loan_convert_bank.shape[1]} columns"
+        )
+
+        loan_convert_adj = timed(
+            "loan_convert_adj",
+            cached,
+            cache,
+            refresh,
+            "loan_convert_adj",
+            today,
+            get_loan_convert_adj_data,
+            loan_convert_id,
+            today,
+            db_connection,
+        )
+
+        loan_convert_adj = get_paid_adj(loan_convert_adj)
+
+        log.info(
+            "loan convert transactions complete, "
+            f"{loan_convert_adj.shape[0]} rows, {loan_convert_adj.shape[1]} columns"
+        )
+
+        loan_convert_agg = timed(
+            "loan_convert_trn_agg", ops["get_trn_agg"], loan_convert_bank, loan_convert_adj
+        )
+
+    log.info(
+        "loan convert aggregation complete, "
+        f"{loan_convert_agg.shape[0]} rows, {loan_convert_agg.shape[1]} columns"
+    )
+
+    params = {
+        "today": today,
+        "date": today if date is None else date,
+        "overrides": overrides,
+    }
+
+    return finish_df(df, loan_convert_agg, outputs, params)
+
+
+def init_worker_log():
+
+    """ the log is bound under __main__, a forked worker inherits it but a spawned one
+        only imports the module, so it gets a logger of its own """
+
+    global log
+
+    if "log" not in globals():
+        log = get_logger().new(worker=os.getpid())
+
+
+SHARD_CONNECTION = None
+
+
+def init_shard_worker(url, engine_options):
+
+    """ each worker process creates its own engine to the source database """
+
+    global SHARD_CONNECTION
+
+    init_worker_log()
+
+    SHARD_CONNECTION = sq.create_engine(url, **engine_options)
+
+
+def compute_shard(shard, today, outputs, kwargs):
+
+    """ compute_df for one shard in a worker process,
+        returns the frame and the stage metrics recorded for it """
+
+    start = len(STAGE_METRICS)
+
+    with stage_tags(shard=shard[0]):
+        df = compute_df(SHARD_CONNECTION, today, outputs, shard=shard, **kwargs)
+
+    return df, STAGE_METRICS[start:]
+
+
+def compute_sharded_df(
+    db_connection,
+    today,
+    shards,
+    outputs=OUTPUT_COLUMNS,
+    processes=None,
+    engine_options=None,
+    **kwargs,
+):
+
+    """ compute_df split into shards by BusinessID % shards, each shard extracted and
+        computed in its own process and the frames concatenated in shard order,
+        every process creates an engine from the url of db_connection and engine_options
+        and opens up to workers connections to the source database """
+
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+
+    outputs = list(outputs)
+
+    log.info(f"computing {shards} shards on {processes or os.cpu_count()} processes")
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=init_shard_worker,
+        initargs=(db_connection.url, engine_options or {}),
+    ) as pool:
+        futures = [
+            pool.submit(compute_shard, (index, shards), today, outputs, kwargs)
+            for index in range(shards)
+        ]
+        frames = []
+        for index, future in enumerate(futures):
+            df, metrics = future.result()
+            STAGE_METRICS.extend(metrics)
+            log.info(f"shard {index + 1} of {shards} complete, {df.shape[0]} rows")
+            frames.append(df)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def upload(
+    db2_session,
+    df,
+    upload_type,
+    cleardate,
+    bulk=False,
+    batch_size=BULK_BATCH_SIZE,
+    swap=False,
+):
+
+    """ replacing the rows for the date of analysis in the daily or historical table """
+
+    if upload_type == "daily":
+        table = "delinquency_daily"
+    elif upload_type == "historical":
+        table = "delinquency_historical"
+    else:
+        raise ValueError("Table may not be undefined")
+
+    log.info(f"{upload_type}")
+
+    log.info(f"{table}")
+
+    if upload_type == "daily":
+        model = Delinquent_Daily
+    elif upload_type == "historical":
+        model = Delinquent_Historical
+    else:
+        raise ValueError("Model may not be undefined")
+
+    log.info(f"{model}")
+
+    if swap:
+        timed("publish_partition", publish_partition, db2_session, df, model, cleardate, batch_size)
+        return
+
+    """ deleting rows for date of analysis if present """
+
+    timed("delete", db2_session.query(model).filter(model.date == cleardate).delete)
+    db2_session.commit()
+
+    log.info("deleted today's data if present")
+
+    log.info(f"attempting to insert {len(df)} records")
+    if bulk:
+        timed("bulk_load", bulk_load, db2_session, df, table, "reports", batch_size)
+        db2_session.commit()
+    else:
+        timed(
+            "load_df_to_table",
+            utl.load_df_to_table,
+            db2_session,
+            df,
+            table,
+            schema="reports",
+            column_name_list=list(df),
+        )
+    log.info(f"inserted {len(df)} records")
+
+
+def get_df(
+    db_connection,
+    db2_session,
+    upload_type,
+    pushdown=False,
+    chunksize=None,
+    workers=EXTRACT_WORKERS,
+    incremental=None,
+    rebuild_days=None,
+    reconcile=False,
+    cache=None,
+    refresh=False,
+    overrides=EXPECTED_AMT_OVERRIDES,
+    backend="pandas",
+    bulk=False,
+    batch_size=BULK_BATCH_SIZE,
+    swap=False,
+    shards=None,
+    processes=None,
+    engine_options=None,
+):
+
+    log.info("beginning process")
+
+    if incremental and upload_type != "daily":
+        raise ValueError("incremental mode is only supported for daily uploads")
+
+    if incremental and shards:
+        raise ValueError("incremental mode can't be combined with sharding")
+
+    """ setting date of analysis to today """
+
+    today = get_today()
+
+    cleardate = date_var(upload_type)
+
+    if shards:
+        df = compute_sharded_df(
+            db_connection,
+            today,
+            shards,
+            OUTPUT_COLUMNS,
+            processes=processes,
+            engine_options=engine_options,
+            workers=workers,
+            date=cleardate,
+            pushdown=pushdown,
+            chunksize=chunksize,
+            cache=cache,
+            refresh=refresh,
+            overrides=overrides,
+            backend=backend,
+        )
+    else:
+        df = compute_df(
+            db_connection,
+            today,
+            OUTPUT_COLUMNS,
+            date=cleardate,
+            pushdown=pushdown,
+            chunksize=chunksize,
+            workers=workers,
+            incremental=incremental,
+            rebuild_days=rebuild_days,
+            reconcile=reconcile,
+            cache=cache,
+            refresh=refresh,
+            overrides=overrides,
+            backend=backend,
+        )
+
+    """ removing extraneous columns """
+
+    df = remove_and_rename(df)
+
+    df = timed("data_cleaning", data_cleaning, df)
+
+    log.info(
+        "data processing complete complete, "
+        f"{df.shape[0]} rows, {df.shape[1]} columns"
+    )
+
+    """ uploading data """
+
+    upload(db2_session, df, upload_type, cleardate, bulk, batch_size, swap)
+
+
+""" historical backfill, the transactions are read once and summed as of each date of analysis """
+
+
+def get_loans(cnxn):
+
+    """ vw_loans and the Loans dates rnkactive ranks, without the date filter of active_loans """
+
+    loans = read_sql(
+        "select * from reporting.vw_loans where LoanID not in ('1','34','57','312')", cnxn
     )
 
-    df["YIBbins"] = np.where(
-        df.YearsInBusiness.isnull(),
-        "No Info",
-        pd.cut(
-            df["YearsInBusiness"],
-            [
-                -np.inf,
-                0,
-                1,
-                2,
-                3,
-                4,
-                5,
-                6,
-                7,
-                8,
-                9,
-                14,
-                19,
-                24,
-                29,
-                34,
-                39,
-                44,
-                49,
-                99,
-                np.inf,
-            ],
-            labels=[
-                "0",
-                "1",
-                "2",
-                "3",
-                "4",
-                "5",
-                "6",
-                "7",
-                "8",
-                "9",
-                "10-14",
-                "15-19",
-                "20-24",
-                "25-29",
-                "30-34",
-                "35-39",
-                "40-44",
-                "45-49",
-                "50-99",
-                "100+",
-            ],
-        ),
+    ranks = read_sql(
+        "select LoanID, BusinessID, Loandate from Loans where LoanID not in ('1','34','57','312')",
+        cnxn,
     )
 
-    df["CreditScorebins"] = pd.cut(
-        df["CreditScore"],
-        [400, 450, 500, 550, 600, 650, 700, 750, 800, 850, 900],
-        labels=[
-            "400-449",
-            "450-499",
-            "500-549",
-            "550-599",
-            "600-649",
-            "650-699",
-            "700-749",
-            "750-799",
-            "800-849",
-            "850-899",
-        ],
-        right=False,
-    )
+    return loans, ranks
 
-    df["CreditScore2bins"] = pd.cut(
-        df["CreditScore2"],
-        [400, 450, 500, 550, 600, 650, 700, 750, 800, 850, 900],
-        labels=[
-            "400-449",
-            "450-499",
-            "500-549",
-            "550-599",
-            "600-649",
-            "650-699",
-            "700-749",
-            "750-799",
-            "800-849",
-            "850-899",
-        ],
-        right=False,
-    )
 
-    return df
+def loans_as_of(loans, ranks, date):
 
+    """ active_loans as of date, rnkactive numbers each business's loans up to date newest first """
 
-def data_cleaning(df):
+    ranks = ranks[ranks["Loandate"] <= date]
 
-    df["caldays"] = np.where(df["caldays"] == np.inf, np.nan, df["caldays"])
+    rnkactive = ranks.groupby("BusinessID")["Loandate"].rank(method="first", ascending=False)
 
-    df["delinquent_payments"] = np.where(
-        df["delinquent_payments"] == np.inf, np.nan, df["delinquent_payments"]
-    )
+    return pd.merge(loans, ranks[["LoanID"]].assign(rnkactive=rnkactive), how="left", on="LoanID")
 
-    df["expected_payments"] = np.where(
-        df["expected_payments"] == np.inf, np.nan, df["expected_payments"]
-    )
 
-    df["paid_payments"] = np.where(
-        df["paid_payments"] == np.inf, np.nan, df["paid_payments"]
+def get_adj_history(date, cnxn):
+
+    """ AdjustmentTransactions up to date with Transdate and TransID, unfiltered
+        so both the regular and the loan convert exclusions can be applied afterwards """
+
+    query = (
+        f"select LoanID, Transdate, OwedAmtAmtPaid, OwedAmtAmtCharged, TransID "
+        f"from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{date}';"
     )
 
-    return df
+    return read_sql(query, cnxn)
 
 
-def modified_pymnt_56(df):
+def exclude_trans(df, trans_ids):
 
-    """ one hard coded edge case """
+    """ rows whose TransID is set and not in trans_ids, like TransID != x in sql """
 
-    if df["dayspassed"] <= 103:
-        return df["dayspassed"] * 200
-    elif df["dayspassed"] > 103:
-        return (103 * 200) + ((df["dayspassed"] - 103) * 500)
+    return df[df["TransID"].notna() & ~df["TransID"].isin(trans_ids)]
 
 
-def expectedamt_cleaning(df, today):
+def as_of_aggregate(df, dates, credit, debit, varname):
 
-    """ more hard coded edge cases
-    and making sure expected amount doesn't exceed amount owed """
+    """ aggregate as of each of the sorted dates in one pass over the rows sorted by Transdate,
+        the rows between consecutive dates are summed once and added to the running total,
+        loans without rows up to a date are left out like they are from aggregate """
 
-    nweeks = weeks_between(pd.to_datetime("2020-7-15"), today)
+    df = df.sort_values("Transdate", kind="stable")
 
-    df["ExpectedAmt"] = np.where(
-        df["LoanID"] == 27, 50600 + (4500 * nweeks), df["ExpectedAmt"]
+    ends = np.searchsorted(
+        df["Transdate"].values, np.asarray(dates, dtype="datetime64[ns]"), side="right"
     )
 
-    df["ExpectedAmt"] = np.where(
-        df["LoanID"] == 99,
-        (55 * 213) + ((df["dayspassed"] - 55) * 700),
-        df["ExpectedAmt"],
-    )
+    total = df.iloc[:0].groupby("LoanID")[[credit, debit]].sum()
 
-    df["ExpectedAmt"] = np.where(
-        df["LoanID"] == 56,
-        df.apply(modified_pymnt_56, axis=1),
-        df["ExpectedAmt"],
-    )
+    aggs = []
+    start = 0
+    for end in ends:
+        total = total.add(
+            df.iloc[start:end].groupby("LoanID")[[credit, debit]].sum(), fill_value=0
+        )
+        start = end
+        aggs.append((total[credit] - total[debit]).to_frame(varname))
 
-    df["ExpectedAmt"] = np.where(
-        df["ExpectedAmt"] > df["AmtOwedAdj"], df["AmtOwedAdj"], df["ExpectedAmt"]
-    )
+    return aggs
 
-    return df
 
+class PaymentIndex:
 
-def remove_and_rename(df):
+    """ per loan transaction dates sorted within the loan with the running bank and adjustment
+        net paid, so amount paid, first payment date and balance as of any date are a binary search
+        for each loan, loans are contiguous segments loan_ids[i] -> offsets[i]:offsets[i + 1]
+        dates are searched at second resolution """
 
-    """ removing extraneous columns """
+    def __init__(self, loan_ids, offsets, seconds, bank_cum, adj_cum, first_bank):
 
-    df = df[
-        [
-            "LoanID",
-            "BusinessID",
-            "Loandate",
-            "FirstTransaction",
-            "firstBankTransactionsdate",
-            "loanAmt",
-            "calcloan_term",
-            "AmtOwed",
-            "CarriedOverBal",
-            "RefinancingFee",
-            "AmtOwedFwded",
-            "AmtOwedAdj",
-            "AmtPaidTodatehack",
-            "loanBalance",
-            "DailyPayment",
-            "dayspassed",
-            "weekspassed",
-            "ExpectedAmt",
-            "AmtDelinquent",
-            "CalDays",
-            "pymnts_delinquent",
-            "PaymentSchedule",
-            "DelinquencyBins",
-            "AnnualRevenueBins",
-            "AnnualRevenueBins2",
-            "YIBbins",
-            "CreditScorebins",
-            "CreditScore2bins",
-            "CreditScore",
-            "CreditScore2",
-            "YearsInBusiness",
-            "AnnualRevenue",
-            "AppType",
-            "industry1",
-            "industry2",
-            "industry3",
-            "industry4",
-            "RepType",
-            "date",
-            "remaining_term",
-            "pymnts_expected",
-            "pymnts_paid",
-        ]
-    ]
-
-    col_names = [
-        "loan_id",
-        "first_BusinessID",
-        "loan_date",
-        "first_trans",
-        "first_BankTransactions_date",
-        "loan_amt",
-        "loan_term",
-        "loan_OwedAmt",
-        "fwded_bal",
-        "fee",
-        "OwedAmt_balance_tofwd",
-        "AmtOwedAdj",
-        "paid_amt_to_date",
-        "loan_balance",
-        "daily_payment",
-        "days",
-        "weeks",
-        "expected_amount",
-        "amt_deliquent",
-        "calandar_days",
-        "delinquent_payments",
-        "payment_type",
-        "bins_delinquency",
-        "revenue_bins",
-        "revenue_bins2",
-        "years_in_business_bins",
-        "CreditScore_bins",
-        "CreditScore2_bins",
-        "CreditScore",
-        "CreditScore2",
-        "years_in_business",
-        "revenue",
-        "application_type",
-        "industry1",
-        "industry2",
-        "industry3",
-        "industry4",
-        "representative_type",
-        "date",
-        "remaining_term",
-        "expected_payments",
-        "paid_payments",
-    ]
-
-    df.columns = col_names
+        self.loan_ids = loan_ids
 
-    return df
+        self.offsets = offsets
 
+        self.seconds = seconds
 
-def loan_balance(df):
+        self.bank_cum = bank_cum
 
-    """ getting balanc """
+        self.adj_cum = adj_cum
 
-    return df["AmtOwedAdj"] - df["AmtPaidTodatehack"]
+        self.first_bank = first_bank
 
+        self.build()
 
-def get_pymnts_delinquent(df):
+    def build(self):
 
-    return df["AmtDelinquent"] / df["DailyPayment"]
+        """ keys[j] places each transaction by loan position then seconds from the first
+            transaction, one sorted array for every loan's segment """
 
+        self.origin = self.seconds.min() if len(self.seconds) else 0
 
-def get_date():
+        self.span = (self.seconds.max() - self.origin + 2) if len(self.seconds) else 1
 
-    """ for historical data uploads, replacing analysis date with
-    first of the month date """
+        loan_pos = np.repeat(np.arange(len(self.loan_ids)), np.diff(self.offsets))
 
-    date = datetime.today().replace(day=1)
+        self.keys = loan_pos * self.span + (self.seconds - self.origin)
 
-    date = date.strftime("%Y-%m-%d")
+    @classmethod
+    def from_transactions(cls, bank, adj):
 
-    return pd.to_datetime(date)
+        """ an index over BankTransactions (AmtPaid, AmtCharged) and already filtered
+            AdjustmentTransactions (OwedAmtAmtPaid, OwedAmtAmtCharged), both with LoanID and Transdate """
 
+        events = pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        "LoanID": bank["LoanID"].astype("int64"),
+                        "Transdate": bank["Transdate"],
+                        "bank": bank["AmtPaid"].fillna(0) - bank["AmtCharged"].fillna(0),
+                        "adj": 0.0,
+                    }
+                ),
+                pd.DataFrame(
+                    {
+                        "LoanID": adj["LoanID"].astype("int64"),
+                        "Transdate": adj["Transdate"],
+                        "bank": 0.0,
+                        "adj": adj["OwedAmtAmtPaid"].fillna(0) - adj["OwedAmtAmtCharged"].fillna(0),
+                    }
+                ),
+            ],
+            ignore_index=True,
+        ).sort_values(["LoanID", "Transdate"], kind="stable")
 
-def date_var(upload_type):
+        loan_ids, starts = np.unique(events["LoanID"].values, return_index=True)
 
-    if upload_type == "daily":
-        return get_today()
-    elif upload_type == "historical":
-        return get_date()
+        loan = events.groupby("LoanID")
 
+        first_bank = bank.groupby(bank["LoanID"].astype("int64"))["Transdate"].min()
 
-def get_df(db_connection, db2_session, upload_type):
+        return cls(
+            loan_ids,
+            np.append(starts, len(events)).astype("int64"),
+            events["Transdate"].values.astype("datetime64[s]").astype("int64"),
+            loan["bank"].cumsum().values,
+            loan["adj"].cumsum().values,
+            first_bank.reindex(loan_ids).values.astype("datetime64[ns]"),
+        )
 
-    log.info("beginning process")
+    def locate(self, loan_ids, date):
 
-    """ setting date of analysis to today """
+        """ for each loan its position (-1 when not indexed) and the index of its last
+            transaction up to date (-1 when there is none) """
 
-    today = get_today()
+        loan_ids = np.asarray(loan_ids, dtype="int64")
 
-    """ loading in data """
+        date = np.broadcast_to(np.asarray(pd.to_datetime(date), dtype="datetime64[s]"), loan_ids.shape)
 
-    activefunds = active_loans(today, db_connection)
+        if not len(self.loan_ids):
+            return np.full(loan_ids.shape, -1), np.full(loan_ids.shape, -1)
 
-    activefunds = transform_active_loans(activefunds)
+        pos = np.minimum(np.searchsorted(self.loan_ids, loan_ids), len(self.loan_ids) - 1)
 
-    BankTransactionsmindate = get_BankTransactions_date_data(today, db_connection)
+        pos = np.where(self.loan_ids[pos] == loan_ids, pos, -1)
 
-    BankTransactionsmindate = min_BankTransactions_date(BankTransactionsmindate)
+        rel = np.clip(date.astype("int64") - self.origin, -1, self.span - 1)
 
-    """ aggregating BankTransactions and AdjustmentTransactions data and combining them to get amt paid to date """
+        last = np.searchsorted(self.keys, pos * self.span + rel, side="right") - 1
 
-    bank = get_bank_data(today, db_connection)
+        found = (pos >= 0) & (last >= self.offsets[np.maximum(pos, 0)])
 
-    bank = get_paid_bank(bank)
+        return pos, np.where(found, last, -1)
 
-    adj = get_adj_data(today, db_connection)
+    def paid(self, loan_ids, date):
 
-    adj = get_paid_adj(adj)
+        """ get_trn_agg's AmtPaidTodate as of date, NaN for loans without transactions up to date """
 
-    agg = get_trn_agg(bank, adj)
+        pos, last = self.locate(loan_ids, date)
 
-    log.info(
-        "data aggregation complete, " f"{agg.shape[0]} rows, {agg.shape[1]} columns"
-    )
+        if not len(self.keys):
+            return np.full(last.shape, np.nan)
 
-    log.info(
-        "data loading complete, "
-        f"{activefunds.shape[0]} rows, {activefunds.shape[1]} columns"
+        return np.where(last >= 0, self.bank_cum[last] + self.adj_cum[last], np.nan)
+
+    def first_payment(self, loan_ids, date):
+
+        """ min_BankTransactions_date as of date, NaT for loans without bank transactions up to date """
+
+        pos, last = self.locate(loan_ids, date)
+
+        if not len(self.keys):
+            return np.full(pos.shape, np.datetime64("NaT"), dtype="datetime64[ns]")
+
+        first = np.where(pos >= 0, self.first_bank[np.maximum(pos, 0)], np.datetime64("NaT"))
+
+        date = np.asarray(pd.to_datetime(date), dtype="datetime64[ns]")
+
+        return np.where(first <= date, first, np.datetime64("NaT"))
+
+    def frames(self, date):
+
+        """ the aggregate and first transaction date frames of every indexed loan as of date,
+            shaped like get_trn_agg and min_BankTransactions_date """
+
+        index = pd.Index(self.loan_ids, name="LoanID")
+
+        agg = pd.DataFrame({"AmtPaidTodate": self.paid(self.loan_ids, date)}, index=index)
+
+        mindate = pd.DataFrame(
+            {"firstBankTransactionsdate": self.first_payment(self.loan_ids, date)}, index=index
+        )
+
+        return agg.dropna(), mindate.dropna()
+
+    def save(self, path):
+        np.savez(
+            path,
+            loan_ids=self.loan_ids,
+            offsets=self.offsets,
+            seconds=self.seconds,
+            bank_cum=self.bank_cum,
+            adj_cum=self.adj_cum,
+            first_bank=self.first_bank,
+        )
+
+    @classmethod
+    def load(cls, path):
+
+        """ a saved index, the search keys are rebuilt """
+
+        saved = np.load(path)
+
+        return cls(
+            *(
+                saved[name]
+                for name in ["loan_ids", "offsets", "seconds", "bank_cum", "adj_cum", "first_bank"]
+            )
+        )
+
+
+def payment_indexes(bank, adj, convert_ids):
+
+    """ the regular and loan convert payment indexes, adj is the unfiltered adjustment history
+        and each index applies the same transaction exclusions as the pipeline """
+
+    return {
+        "regular": PaymentIndex.from_transactions(bank, exclude_trans(adj, [15, 4])),
+        "loan_convert": PaymentIndex.from_transactions(
+            bank[bank["LoanID"].isin(convert_ids)],
+            exclude_trans(adj[adj["LoanID"].isin(convert_ids)], [91, 97, 34]),
+        ),
+    }
+
+
+def save_payment_indexes(path, indexes):
+    os.makedirs(path, exist_ok=True)
+
+    for name, index in indexes.items():
+        index.save(os.path.join(path, f"{name}.npz"))
+
+
+def build_payment_indexes(date, cnxn, path=None):
+
+    """ the payment indexes over transactions up to date,
+        saved to path/regular.npz and path/loan_convert.npz when path is set """
+
+    indexes = payment_indexes(
+        get_bank_data(date, cnxn), get_adj_history(date, cnxn), get_loan_convert_loans(cnxn)["LoanID"]
     )
 
-    """ merging datasets to main df """
+    if path:
+        save_payment_indexes(path, indexes)
 
-    df = merge_data(activefunds, agg, BankTransactionsmindate)
+    return indexes
 
-    log.info("dataset merge complete, " f"{df.shape[0]} rows, {df.shape[1]} columns")
 
-    """ getting payment start date """
+def load_payment_indexes(path):
+    return {name: PaymentIndex.load(os.path.join(path, f"{name}.npz")) for name in ["regular", "loan_convert"]}
 
-    df["bdstartdate"] = pymnt_start(df)
 
-    """ consolidating amt paid to date with edge cases """
+def payments_as_of(indexes, loans, date):
+
+    """ AmtPaidTodate, AmtPaidTodatehack, firstBankTransactionsdate and loanBalance as of date
+        for loans with LoanID and AmtOwedAdj, like the pipeline loanBalance is taken before
+        the loan convert replacement of amt paid """
+
+    regular = indexes["regular"]
+
+    df = loans[["LoanID", "AmtOwedAdj"]].copy()
+
+    df["AmtPaidTodate"] = regular.paid(df["LoanID"], date)
+
+    df["firstBankTransactionsdate"] = regular.first_payment(df["LoanID"], date)
 
     df["AmtPaidTodatehack"] = amt_paid(df)
 
-    """ calculating loanBalance to date """
+    df["loanBalance"] = loan_balance(df)
 
-    df["loanBalance"] = df[["AmtOwedAdj", "AmtPaidTodatehack"]].apply(
-        loan_balance, axis=1
-    )
+    df["AmtPaidTodatehack"] = pd.Series(
+        indexes["loan_convert"].paid(df["LoanID"], date), index=df.index
+    ).fillna(df["AmtPaidTodatehack"])
 
-    log.info(
-        "loan balance calculation complete, "
-        f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+    return df
 
-    """ filtering out any edge cases with data errors and selecting currently active loans """
 
-    df = select_df(df, today)
+def backfill_dates(start, end):
 
-    log.info(
-        "edge case filtering complete, " f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+    """ the historical snapshot dates, the month starts from start to end """
 
-    """ special calculations for loans with a certain transaction type to exclude it """
+    return pd.date_range(pd.to_datetime(start), pd.to_datetime(end), freq="MS")
 
-    query = """select LoanID from reporting.vw_AdjustmentTransactions_transactions vtat where TransID = 34"""
 
-    loan_convert = pd.read_sql(query, db_connection)
+def backfill_sources(db_connection, today, workers=EXTRACT_WORKERS):
 
-    loan_convert = pd.merge(df, loan_convert, how="inner", on="LoanID")
+    """ loans with their ranks, the paid transactions up to the last date of analysis
+        and the loan convert loans, everything the backfilled dates are computed from """
 
-    loan_convert_id = loan_convert["LoanID"].to_list()
+    queries = {
+        "loans": (get_loans, db_connection),
+        "bank": (get_bank_data, today, db_connection),
+        "adj": (get_adj_history, today, db_connection),
+        "loan_convert": (get_loan_convert_loans, db_connection),
+    }
 
-    loan_convert_bank = []
-    for loan_id in loan_convert_id:
-        bankquery = (
-            f"select LoanID, AmtPaid, AmtCharged "
-            f"from reporting.vw_BankTransactions_transactions where Transdate <= '{today}' "
-            f"and LoanID = '{loan_id}';"
-        )
-        loan_convert_df = pd.read_sql(bankquery, db_connection)
-        loan_convert_bank.append(loan_convert_df)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(timed, name, *query) for name, query in queries.items()}
+        sources = {name: future.result() for name, future in futures.items()}
 
-    loan_convert_bank = pd.concat(loan_convert_bank)
+    loans, ranks = sources["loans"]
 
-    loan_convert_bank = get_paid_bank(loan_convert_bank)
+    return {
+        "loans": loans,
+        "ranks": ranks,
+        "bank": get_paid_bank(sources["bank"]),
+        "adj": get_paid_adj(sources["adj"]),
+        "loan_convert": sources["loan_convert"],
+    }
 
-    log.info(
-        "loan convert transactions complete, "
-        f"{loan_convert_bank.shape[0]} rows, {loan_convert_bank.shape[1]} columns"
-    )
 
-    loan_convert_adj = []
-    for loan_id in loan_convert_id:
-        adjquery = (
-            f"select BusinessID, LoanID, OwedAmtAmtPaid, OwedAmtAmtCharged, TransID, "
-            f" dense_rank() over (partition by BusinessID order by LoanID desc) rnk"
-            f" from reporting.vw_AdjustmentTransactions_transactions where Transdate <= '{today}' "
-            f"and LoanID = '{loan_id}' and TransID != 91 and TransID != 97"
-            " and TransID != 34;"
-        )
-        loan_convert_df = pd.read_sql(adjquery, db_connection)
-        loan_convert_adj.append(loan_convert_df)
+def backfill_frames(sources, cleardates, overrides=EXPECTED_AMT_OVERRIDES, backend="pandas"):
 
-    loan_convert_adj = pd.concat(loan_convert_adj)
+    """ yields each clear date with its upload frame, the date of analysis is the one a run
+        on that clear date would use, amounts and first transaction dates come from the
+        source transactions as of that date, or from payment indexes when sources has
+        indexes instead of transactions, and the base frame, loan convert and stages
+        are the same as get_df """
 
-    loan_convert_adj = get_paid_adj(loan_convert_adj)
+    todays = [analysis_date(cleardate) for cleardate in cleardates]
 
-    log.info(
-        "loan convert transactions complete, "
-        f"{loan_convert_adj.shape[0]} rows, {loan_convert_adj.shape[1]} columns"
-    )
+    ops = get_backend(backend)
 
-    loan_convert_agg = get_trn_agg(loan_convert_bank, loan_convert_adj)
+    loans, ranks = sources["loans"], sources["ranks"]
 
-    log.info(
-        "loan convert aggregation complete, "
-        f"{loan_convert_agg.shape[0]} rows, {loan_convert_agg.shape[1]} columns"
-    )
+    if "indexes" in sources:
+        regular, convert = sources["indexes"]["regular"], sources["indexes"]["loan_convert"]
 
-    df = pd.merge(df, loan_convert_agg, how="left", on="LoanID")
+        amounts = ((*regular.frames(today), convert.frames(today)[0]) for today in todays)
+    else:
+        amounts = as_of_amounts(sources, todays)
 
-    log.info("dataset merge complete, " f"{df.shape[0]} rows, {df.shape[1]} columns")
+    columns = stage_columns(OUTPUT_COLUMNS).union(BASE_COLUMNS)
 
-    df["AmtPaidTodatehack"] = df["AmtPaidTodate_y"].fillna(df["AmtPaidTodatehack"])
+    for cleardate, today, (agg, mindate, convert_agg) in zip(cleardates, todays, amounts):
+        with stage_tags(date=f"{cleardate:%Y-%m-%d}"):
+            activefunds = transform_active_loans(loans_as_of(loans, ranks, today))
 
-    """ getting business days and weeks passed for loans """
+            activefunds = activefunds[[column for column in activefunds.columns if column in columns]]
 
-    df["PaymentSchedule"] = df["PaymentSchedule"].str.lower()
+            df = timed("base_frame", ops["base_frame"], activefunds, agg, mindate, today)
 
-    df = time_passed(df, today)
+            params = {"today": today, "date": cleardate, "overrides": overrides}
 
-    log.info(
-        "business day and weeks passed calculations complete, "
-        f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+            df = finish_df(df, convert_agg, OUTPUT_COLUMNS, params)
 
-    """ calculating payments delinquent
-        correcting for expected amt exceeds AmtOwedAdj """
+            df = data_cleaning(remove_and_rename(df))
 
-    df["ExpectedAmt"] = df[
-        ["DailyPayment", "PaymentSchedule", "weekspassed", "dayspassed"]
-    ].apply(expectedamt, axis=1)
+        yield cleardate, df
 
-    df = expectedamt_cleaning(df, today)
 
-    df["AmtDeliquent"] = delinquent_amount(df)
+def as_of_amounts(sources, todays):
+
+    """ amt paid to date, first bank transaction date and loan convert amt paid to date
+        as of each of todays from one pass over the source transactions,
+        the regular adjustments exclude refi fees, the loan convert adjustments
+        exclude the convert itself """
+
+    bank, adj = sources["bank"], sources["adj"]
+
+    convert_ids = sources["loan_convert"]["LoanID"]
+
+    aggbank = as_of_aggregate(bank, todays, "AmtPaid", "AmtCharged", "bankamt")
 
-    df["pymnts_delinquent"] = df[["AmtDelinquent", "DailyPayment"]].apply(
-        get_pymnts_delinquent, axis=1
+    aggadj = as_of_aggregate(
+        exclude_trans(adj, [15, 4]), todays, "OwedAmtAmtPaid", "OwedAmtAmtCharged", "adjamt"
     )
 
-    log.info(
-        "payments delinquent calculations complete, "
-        f"{df.shape[0]} rows, {df.shape[1]} columns"
+    convert_aggbank = as_of_aggregate(
+        bank[bank["LoanID"].isin(convert_ids)], todays, "AmtPaid", "AmtCharged", "bankamt"
     )
 
-    """ conversion of payments behind (business days behind) to minutes and getting decimal value
-        for calendar days behind """
+    convert_aggadj = as_of_aggregate(
+        exclude_trans(adj[adj["LoanID"].isin(convert_ids)], [91, 97, 34]),
+        todays,
+        "OwedAmtAmtPaid",
+        "OwedAmtAmtCharged",
+        "adjamt",
+    )
 
-    df["CalDays"] = get_caldays(df, today)
+    first = bank.groupby("LoanID")["Transdate"].min()
 
-    log.info(
-        "initial calendar day calculations complete, "
-        f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+    for i, today in enumerate(todays):
+        yield (
+            merge_trn_agg(aggbank[i], aggadj[i]),
+            first[first <= today].to_frame("firstBankTransactionsdate"),
+            merge_trn_agg(convert_aggbank[i], convert_aggadj[i]),
+        )
 
-    """ creating a flag where if payments are only delinquent in the week of analysis, then
-        calendar days behind = payments delinquent and calendar days cleaning """
 
-    df["CalDays"] = clean_caldays(df, today)
+def backfill(
+    db_connection,
+    db2_session,
+    start,
+    end,
+    workers=EXTRACT_WORKERS,
+    overrides=EXPECTED_AMT_OVERRIDES,
+    backend="pandas",
+    bulk=False,
+    batch_size=BULK_BATCH_SIZE,
+    swap=False,
+):
 
-    log.info(
-        "calendar days cleaning complete, " f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+    """ historical uploads for every month start from start to end from one extraction """
 
-    """
-    alternative method for calculating calendar days-- faster but less accurate
+    cleardates = backfill_dates(start, end)
 
-    df['CalDays'] = np.where(df['pymnts_delinquent']<5, df['pymnts_delinquent'],
-                             np.floor(df['pymnts_delinquent']/5)*7 + (df['pymnts_delinquent']%5))
-    """
+    if cleardates.empty:
+        raise ValueError(f"no month starts between {start} and {end}")
 
-    """ getting payment information """
+    log.info(f"backfilling {len(cleardates)} dates from {cleardates[0]} to {cleardates[-1]}")
 
-    df = pyment_info(df)
+    """ loading in data once up to the last date of analysis """
 
-    log.info(
-        "payment calculations complete, " f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+    sources = backfill_sources(db_connection, analysis_date(cleardates[-1]), workers)
 
-    """ binning """
+    frames = backfill_frames(sources, cleardates, overrides, backend)
 
-    df = bins(df)
+    for i, (cleardate, df) in enumerate(frames):
+        with stage_tags(date=f"{cleardate:%Y-%m-%d}"):
+            upload(db2_session, df, "historical", cleardate, bulk, batch_size, swap)
 
-    log.info("binning complete, " f"{df.shape[0]} rows, {df.shape[1]} columns")
+        log.info(f"backfill of {cleardate:%Y-%m-%d} complete, {i + 1} of {len(cleardates)} dates")
 
-    """ calculating remaining loan_term """
 
-    df = get_remain_loan_term(df, today)
+""" process parallel backfill, the sources are extracted once and shared read only through
+    parquet files and payment indexes, the dates are computed on a process pool and
+    published in date order """
 
-    log.info(
-        "remaining loan_term calculation complete, "
-        f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
 
-    cleardate = date_var(upload_type)
+BACKFILL_RETRIES = 2
 
-    """ creating date of analysis variable for record keeping as data becomes historical """
+BACKFILL_SOURCE_NAMES = ["loans", "ranks"]
 
-    df["date"] = cleardate
+BACKFILL_SOURCES = None
 
-    """ removing extraneous columns """
 
-    df = remove_and_rename(df)
+def save_backfill_sources(path, sources):
 
-    df = data_cleaning(df)
+    """ the loans and their ranks as parquet and the transactions as payment indexes,
+        so each worker answers its date by binary search instead of summing the transactions,
+        the indexes are written last and mark the sources as complete """
 
-    log.info(
-        "data processing complete complete, "
-        f"{df.shape[0]} rows, {df.shape[1]} columns"
-    )
+    os.makedirs(path, exist_ok=True)
 
-    """ uploading data """
+    for name in BACKFILL_SOURCE_NAMES:
+        write_parquet(sources[name], os.path.join(path, f"{name}.parquet"))
 
-    if upload_type == "daily":
-        table = "delinquency_daily"
-    elif upload_type == "historical":
-        table = "delinquency_historical"
-    else:
-        raise ValueError("Table may not be undefined")
+    indexes = payment_indexes(sources["bank"], sources["adj"], sources["loan_convert"]["LoanID"])
 
-    log.info(f"{upload_type}")
+    save_payment_indexes(os.path.join(path, "indexes"), indexes)
 
-    log.info(f"{table}")
 
-    if upload_type == "daily":
-        model = Delinquent_Daily
-    elif upload_type == "historical":
-        model = Delinquent_Historical
-    else:
-        raise ValueError("Model may not be undefined")
+def load_backfill_sources(path):
 
-    log.info(f"{model}")
+    """ the saved loans with memory mapped reads and the payment indexes,
+        None if they are not all there """
 
-    """ deleting rows for date of analysis if present """
+    paths = {name: os.path.join(path, f"{name}.parquet") for name in BACKFILL_SOURCE_NAMES}
 
-    db2_session.query(model).filter(model.date == cleardate).delete()
-    db2_session.commit()
+    indexes = os.path.join(path, "indexes")
 
-    log.info("deleted today's data if present")
+    if not all(os.path.exists(p) for p in paths.values()) or not os.path.exists(
+        os.path.join(indexes, "loan_convert.npz")
+    ):
+        return None
 
-    log.info(f"attempting to insert {len(df)} records")
-    utl.load_df_to_table(
-        db2_session, df, table, schema="reports", column_name_list=list(df)
+    sources = {name: pd.read_parquet(p, memory_map=True) for name, p in paths.items()}
+
+    sources["indexes"] = load_payment_indexes(indexes)
+
+    return sources
+
+
+def load_backfill_status(state_dir):
+
+    """ per clear date status, attempts and last error of earlier runs,
+        failed dates get a fresh set of attempts """
+
+    path = os.path.join(state_dir, "status.json")
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        status = json.load(f)
+
+    for entry in status.values():
+        if entry["status"] == "failed":
+            entry.update(status="pending", attempts=0)
+
+    return status
+
+
+def save_backfill_status(state_dir, status):
+    with open(os.path.join(state_dir, "status.json.tmp"), "w") as f:
+        json.dump(status, f, indent=1, sort_keys=True)
+
+    os.replace(os.path.join(state_dir, "status.json.tmp"), os.path.join(state_dir, "status.json"))
+
+
+def init_backfill_worker(path):
+
+    """ loading the shared sources and setting up the log once per worker process """
+
+    global BACKFILL_SOURCES
+
+    init_worker_log()
+
+    BACKFILL_SOURCES = load_backfill_sources(path)
+
+
+def backfill_date(cleardate, path, overrides=EXPECTED_AMT_OVERRIDES, backend="pandas"):
+
+    """ computing one clear date in a worker and writing its frame to path,
+        returns the stage metrics recorded for it so the parent can report them """
+
+    start = len(STAGE_METRICS)
+
+    for _, df in backfill_frames(BACKFILL_SOURCES, [cleardate], overrides, backend):
+        write_parquet(df, path)
+
+    return STAGE_METRICS[start:]
+
+
+def publish_ready(db2_session, state_dir, status, keys, bulk, batch_size, swap):
+
+    """ uploading computed dates in date order up to the first date that isn't computed,
+        published frames are removed """
+
+    for key in keys:
+        if status[key]["status"] == "published":
+            continue
+        if status[key]["status"] != "computed":
+            return
+
+        path = os.path.join(state_dir, "frames", f"{key}.parquet")
+
+        with stage_tags(date=key):
+            upload(db2_session, pd.read_parquet(path), "historical", pd.to_datetime(key), bulk, batch_size, swap)
+
+        status[key]["status"] = "published"
+
+        save_backfill_status(state_dir, status)
+
+        os.remove(path)
+
+        log.info(f"backfill of {key} published")
+
+
+def parallel_backfill(
+    db_connection,
+    db2_session,
+    start,
+    end,
+    state_dir,
+    processes=None,
+    workers=EXTRACT_WORKERS,
+    retries=BACKFILL_RETRIES,
+    overrides=EXPECTED_AMT_OVERRIDES,
+    backend="pandas",
+    bulk=False,
+    batch_size=BULK_BATCH_SIZE,
+    swap=False,
+):
+
+    """ backfill of every month start from start to end on a pool of processes
+        the source database is only read by the one extraction on workers connections,
+        the workers compute from the saved sources and the warehouse is written by this
+        process alone, in date order
+        the status of each date is kept in state_dir/status.json, a rerun skips published
+        dates, reuses computed frames and retries failed dates up to retries more times """
+
+    cleardates = backfill_dates(start, end)
+
+    if cleardates.empty:
+        raise ValueError(f"no month starts between {start} and {end}")
+
+    keys = [f"{cleardate:%Y-%m-%d}" for cleardate in cleardates]
+
+    os.makedirs(os.path.join(state_dir, "frames"), exist_ok=True)
+
+    status = load_backfill_status(state_dir)
+
+    def frame_path(key):
+        return os.path.join(state_dir, "frames", f"{key}.parquet")
+
+    for key in keys:
+        entry = status.setdefault(key, {"status": "pending", "attempts": 0, "error": None})
+        if entry["status"] == "computed" and not os.path.exists(frame_path(key)):
+            entry["status"] = "pending"
+
+    todo = [cleardate for cleardate, key in zip(cleardates, keys) if status[key]["status"] == "pending"]
+
+    log.info(
+        f"backfilling {len(cleardates)} dates from {keys[0]} to {keys[-1]}, "
+        f"{len(todo)} to compute on {processes or os.cpu_count()} processes"
     )
-    log.info(f"inserted {len(df)} records")
+
+    try:
+        if todo:
+            today = analysis_date(cleardates[-1])
+
+            inputs = os.path.join(state_dir, "sources", f"{today:%Y-%m-%d}")
+
+            if load_backfill_sources(inputs) is None:
+                save_backfill_sources(inputs, backfill_sources(db_connection, today, workers))
+
+            with ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=init_backfill_worker,
+                initargs=(inputs,),
+            ) as pool:
+                running = {}
+
+                def submit(cleardate):
+                    key = f"{cleardate:%Y-%m-%d}"
+                    future = pool.submit(backfill_date, cleardate, frame_path(key), overrides, backend)
+                    running[future] = key
+
+                for cleardate in todo:
+                    submit(cleardate)
+
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key = running.pop(future)
+                        entry = status[key]
+                        entry["attempts"] += 1
+                        try:
+                            STAGE_METRICS.extend(future.result())
+                        except Exception as e:
+                            entry["error"] = repr(e)
+                            if entry["attempts"] <= retries:
+                                log.warning(f"backfill of {key} failed, retrying: {e!r}")
+                                submit(pd.to_datetime(key))
+                            else:
+                                log.warning(f"backfill of {key} failed: {e!r}")
+                                entry["status"] = "failed"
+                        else:
+                            entry.update(status="computed", error=None)
+                            log.info(f"backfill of {key} computed")
+                    save_backfill_status(state_dir, status)
+                    publish_ready(db2_session, state_dir, status, keys, bulk, batch_size, swap)
+
+        publish_ready(db2_session, state_dir, status, keys, bulk, batch_size, swap)
+    finally:
+        save_backfill_status(state_dir, status)
+
+    failed = [key for key in keys if status[key]["status"] == "failed"]
+
+    if failed:
+        raise RuntimeError(f"backfill failed for {', '.join(failed)}, rerun to resume")
 
 
 if __name__ == "__main__":
@@ -1083,11 +3404,122 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--upload-type")
+    parser.add_argument("--from", dest="start", metavar="DATE")
+    parser.add_argument("--to", dest="end", metavar="DATE")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--shards", type=int)
+    parser.add_argument("--backfill-state", metavar="STATE_DIR")
+    parser.add_argument("--retries", type=int, default=BACKFILL_RETRIES)
+    parser.add_argument("--pushdown", action="store_true")
+    parser.add_argument("--chunksize", type=int)
+    parser.add_argument("--workers", type=int, default=EXTRACT_WORKERS)
+    parser.add_argument("--incremental", metavar="STATE_DIR")
+    parser.add_argument("--rebuild-days", type=int)
+    parser.add_argument("--reconcile", action="store_true")
+    parser.add_argument("--cache", metavar="CACHE_DIR")
+    parser.add_argument("--refresh", action="store_true")
+    parser.add_argument("--cache-max-gb", type=float)
+    parser.add_argument("--cache-max-age-days", type=float)
+    parser.add_argument("--calendar-cache", metavar="CALENDAR_DIR")
+    parser.add_argument("--overrides", metavar="OVERRIDES_CSV")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="pandas")
+    parser.add_argument("--bulk-load", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument("--swap", action="store_true")
+    parser.add_argument("--build-payment-index", metavar="INDEX_DIR")
+    parser.add_argument("--run-report", metavar="REPORT_JSON")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--profile-stage", metavar="STAGE")
+    parser.add_argument("--profile-dir", default=".")
     args = parser.parse_args()
+    CALENDAR_CACHE = args.calendar_cache
+    PROFILE_STAGE = args.profile_stage
+    PROFILE_DIR = args.profile_dir
+    if args.trace_memory:
+        tracemalloc.start()
+    started = datetime.utcnow()
     conf = config.Config()
-    db2_engine = sq.create_engine(conf.db2_connect_str)
+    db2_url = sq.engine.make_url(conf.db2_connect_str)
+    db2_engine = sq.create_engine(
+        db2_url,
+        **({"fast_executemany": True} if db2_url.get_driver_name() == "pyodbc" else {}),
+    )
     WHSession = sessionmaker(bind=db2_engine)
     wh_session = WHSession()
-    db_engine = sq.create_engine(conf.db_connect_str)
+    db_options = {"pool_size": args.workers, "max_overflow": 0}
+    db_engine = sq.create_engine(conf.db_connect_str, **db_options)
     log.info(f"{args.upload_type}")
-    get_df(db_engine, wh_session, args.upload_type)
+    evict_cache(
+        args.cache,
+        args.cache_max_gb * 1024 ** 3 if args.cache_max_gb else None,
+        args.cache_max_age_days,
+    )
+    overrides = load_overrides(args.overrides) if args.overrides else EXPECTED_AMT_OVERRIDES
+    try:
+        if args.build_payment_index:
+            build_payment_indexes(get_today(), db_engine, args.build_payment_index)
+        elif args.start:
+            if args.upload_type != "historical":
+                raise ValueError("--from/--to backfills are only supported for historical uploads")
+            if args.shards:
+                raise ValueError("--from/--to backfills can't be combined with --shards")
+            if args.backfill_state:
+                parallel_backfill(
+                    db_engine,
+                    wh_session,
+                    args.start,
+                    args.end or args.start,
+                    args.backfill_state,
+                    processes=args.processes,
+                    workers=args.workers,
+                    retries=args.retries,
+                    overrides=overrides,
+                    backend=args.backend,
+                    bulk=args.bulk_load,
+                    batch_size=args.batch_size,
+                    swap=args.swap,
+                )
+            else:
+                backfill(
+                    db_engine,
+                    wh_session,
+                    args.start,
+                    args.end or args.start,
+                    workers=args.workers,
+                    overrides=overrides,
+                    backend=args.backend,
+                    bulk=args.bulk_load,
+                    batch_size=args.batch_size,
+                    swap=args.swap,
+                )
+        else:
+            get_df(
+                db_engine,
+                wh_session,
+                args.upload_type,
+                pushdown=args.pushdown,
+                chunksize=args.chunksize,
+                workers=args.workers,
+                incremental=args.incremental,
+                rebuild_days=args.rebuild_days,
+                reconcile=args.reconcile,
+                cache=args.cache,
+                refresh=args.refresh,
+                overrides=overrides,
+                backend=args.backend,
+                bulk=args.bulk_load,
+                batch_size=args.batch_size,
+                swap=args.swap,
+                shards=args.shards,
+                processes=args.processes,
+                engine_options=db_options,
+            )
+    finally:
+        if args.run_report:
+            write_run_report(
+                args.run_report,
+                upload_type=args.upload_type,
+                backend=args.backend,
+                started=started.isoformat(),
+                wall_s=round((datetime.utcnow() - started).total_seconds(), 4),
+            )
@@ -1,6 +1,16 @@
+import os
+import json
+import multiprocessing
+import warnings
+import pytest
 import pandas as pd
 import numpy as np
+import sqlalchemy as sq
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import declarative_base
 from reporting.source.delinquency import delinquency_project as dd
+from reporting.source.delinquency.delinquency_benchmark import build_source_db, source_options
+from loggers import get_logger
 from datetime import datetime
 
 
@@ -409,21 +419,21 @@ def test_expectedamt_cleaning():
 def test_data_cleaning():
     df = pd.DataFrame.from_dict(
         {
-            "caldays": [np.inf, 5, 3, 10],
-            "payments_delinquent": [2, np.inf, 4, 8],
-            "payments_expected": [5, 4, np.inf, 10],
-            "payments_paid": [3, 2, np.inf, 9],
+            "calandar_days": [np.inf, 5, 3, 10],
+            "delinquent_payments": [2, np.inf, 4, 8],
+            "expected_payments": [5, 4, np.inf, 10],
+            "paid_payments": [3, 2, np.inf, 9],
         }
     )
     df = dd.data_cleaning(df)
-    assert df["caldays"].isnull().sum() == 1
-    assert df["payments_delinquent"].isnull().sum() == 1
-    assert df["payments_expected"].isnull().sum() == 1
-    assert df["payments_paid"].isnull().sum() == 1
-    assert df["caldays"].sum() == 18
-    assert df["payments_delinquent"].sum() == 14
-    assert df["payments_expected"].sum() == 19
-    assert df["payments_paid"].sum() == 14
+    assert df["calandar_days"].isnull().sum() == 1
+    assert df["delinquent_payments"].isnull().sum() == 1
+    assert df["expected_payments"].isnull().sum() == 1
+    assert df["paid_payments"].isnull().sum() == 1
+    assert df["calandar_days"].sum() == 18
+    assert df["delinquent_payments"].sum() == 14
+    assert df["expected_payments"].sum() == 19
+    assert df["paid_payments"].sum() == 14
 
 
 def test_remove_and_rename():
@@ -569,3 +579,775 @@ def test_modified_pymnt_1215888():
         df["ExpectedAmt"],
     )
     assert df["ExpectedAmt"].sum() == 52385.84
+
+
+def test_id_chunks():
+    chunks = list(dd.id_chunks([1, 2, 3, 4, 5], 2))
+    assert chunks == ["'1', '2'", "'3', '4'", "'5'"]
+
+
+def sqlite_source(bank, adj):
+    engine = sq.create_engine("sqlite://")
+
+    @sq.event.listens_for(engine, "connect")
+    def attach_reporting(dbapi_connection, connection_record):
+        dbapi_connection.execute("attach database ':memory:' as reporting")
+
+    bank.to_sql("vw_BankTransactions_transactions", engine, schema="reporting", index=False)
+    adj.to_sql("vw_AdjustmentTransactions_transactions", engine, schema="reporting", index=False)
+    return engine
+
+
+def trn_source():
+    bank = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 1, 2, 2, 3, 4],
+            "Transdate": [
+                "2020-01-02 00:00:00",
+                "2020-01-01 00:00:00",
+                "2020-01-05 00:00:00",
+                "2020-02-05 00:00:00",
+                "2020-01-03 00:00:00",
+                "2020-01-03 00:00:00",
+            ],
+            "AmtPaid": [100, 50, np.nan, 30, 20, 10],
+            "AmtCharged": [np.nan, 5, 10, np.nan, np.nan, 1],
+        }
+    )
+    adj = pd.DataFrame.from_dict(
+        {
+            "BusinessID": [1, 1, 2, 2, 3, 5],
+            "LoanID": [1, 1, 2, 3, 4, 5],
+            "Transdate": [
+                "2020-01-02 00:00:00",
+                "2020-01-03 00:00:00",
+                "2020-01-05 00:00:00",
+                "2020-01-06 00:00:00",
+                "2020-01-01 00:00:00",
+                "2020-01-01 00:00:00",
+            ],
+            "OwedAmtAmtPaid": [10, np.nan, 30, 40, 5, 7],
+            "OwedAmtAmtCharged": [np.nan, 3, np.nan, 1, 2, 0],
+            "TransID": [1, 15, 20, 34, 91, 1],
+        }
+    )
+    return sqlite_source(bank, adj)
+
+
+def test_pushdown_parity():
+    date = pd.to_datetime("2020-01-31")
+    cnxn = trn_source()
+    bank = dd.get_bank_data(date, cnxn)
+    mindate = dd.min_BankTransactions_date(bank)
+    agg = dd.get_trn_agg(dd.get_paid_bank(bank), dd.get_paid_adj(dd.get_adj_data(date, cnxn)))
+    aggbank = dd.get_bank_agg_data(date, cnxn)
+    pushdown = dd.merge_trn_agg(aggbank[["bankamt"]], dd.get_adj_agg_data(date, cnxn))
+    pd.testing.assert_frame_equal(agg, pushdown, check_dtype=False)
+    pd.testing.assert_frame_equal(mindate, aggbank[["firstBankTransactionsdate"]])
+
+
+def test_loan_convert_pushdown_parity():
+    date = pd.to_datetime("2020-01-31")
+    cnxn = trn_source()
+    bank = dd.get_paid_bank(dd.get_loan_convert_bank_data([1, 3, 4], date, cnxn, chunksize=2))
+    adj = dd.get_paid_adj(dd.get_loan_convert_adj_data([1, 3, 4], date, cnxn, chunksize=2))
+    agg = dd.get_trn_agg(bank, adj)
+    pushdown = dd.get_loan_convert_agg_data([1, 3, 4], date, cnxn, chunksize=2)
+    pd.testing.assert_frame_equal(agg, pushdown, check_dtype=False)
+
+
+def test_stream_agg_parity():
+    date = pd.to_datetime("2020-01-31")
+    cnxn = trn_source()
+    bank = dd.get_bank_data(date, cnxn)
+    mindate = dd.min_BankTransactions_date(bank)
+    agg = dd.get_trn_agg(dd.get_paid_bank(bank), dd.get_paid_adj(dd.get_adj_data(date, cnxn)))
+    aggbank, streamed_mindate = dd.stream_bank_agg(date, cnxn, chunksize=2)
+    streamed = dd.merge_trn_agg(aggbank, dd.stream_adj_agg(date, cnxn, chunksize=2))
+    pd.testing.assert_frame_equal(agg, streamed, check_dtype=False)
+    pd.testing.assert_frame_equal(mindate, streamed_mindate)
+
+
+def test_fold_chunks():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame.from_dict(
+        {
+            "LoanID": rng.integers(0, 20, 200),
+            "AmtPaid": rng.integers(0, 100, 200).astype(float),
+            "Transdate": pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 300, 200), unit="D"),
+        }
+    )
+    spec = {"AmtPaid": "sum", "Transdate": "min"}
+    chunks = (df.iloc[i : i + 7] for i in range(0, len(df), 7))
+    pd.testing.assert_frame_equal(dd.fold_chunks(chunks, spec, batch=3), df.groupby("LoanID").agg(spec))
+    assert dd.fold_chunks(iter([]), spec) is None
+
+
+def test_update_running_totals(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    cnxn = trn_source()
+    dd.update_running_totals(pd.to_datetime("2020-01-03"), cnxn, str(tmp_path))
+    date = pd.to_datetime("2020-01-31")
+    totals = dd.update_running_totals(date, cnxn, str(tmp_path), reconcile=True)
+    agg, mindate = dd.running_totals_agg(totals)
+    bank = dd.get_bank_data(date, cnxn)
+    full = dd.get_trn_agg(dd.get_paid_bank(bank), dd.get_paid_adj(dd.get_adj_data(date, cnxn)))
+    pd.testing.assert_frame_equal(full, agg, check_dtype=False)
+    assert mindate["firstBankTransactionsdate"].min() == pd.to_datetime("2020-01-01")
+    assert dd.load_running_totals(str(tmp_path))[1]["watermark"] == str(date)
+
+
+def test_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    calls = []
+
+    def extract(date):
+        calls.append(date)
+        return pd.DataFrame.from_dict({"LoanID": [1, 2], "x": [3.0, 4.0]})
+
+    date = pd.to_datetime("2020-01-31")
+    df = dd.cached(str(tmp_path), False, "test", date, extract, date)
+    cached_df = dd.cached(str(tmp_path), False, "test", date, extract, date)
+    pd.testing.assert_frame_equal(df, cached_df)
+    assert len(calls) == 1
+    dd.cached(str(tmp_path), True, "test", date, extract, date)
+    assert len(calls) == 2
+    dd.evict_cache(str(tmp_path), max_bytes=0)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_apply_schema():
+    df = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 2, 3],
+            "BusinessID": [1, np.nan, 3],
+            "PaymentSchedule": ["Daily", "Weekly", "Daily"],
+            "Transdate": ["2020-01-01", "2020-01-02", "2020-01-03"],
+            "AmtPaid": [1.5, 2.5, 3.5],
+        }
+    )
+    df = dd.apply_schema(df)
+    assert df["LoanID"].dtype == "int32"
+    assert df["BusinessID"].dtype == "Int32"
+    assert df["PaymentSchedule"].dtype == "category"
+    assert df["Transdate"].dtype == "datetime64[ns]"
+    assert df["AmtPaid"].dtype == "float64"
+    df = pd.DataFrame.from_dict(
+        {"LoanID": [2 ** 40, 1], "BusinessID": [2 ** 31, np.nan], "AmtPaid": [1.0, 2.0]}
+    ).set_index("LoanID")
+    df = dd.apply_schema(df)
+    assert df.index.tolist() == [2 ** 40, 1]
+    assert df.index.dtype == "int64"
+    assert df["BusinessID"].dtype == "Int64"
+    assert df["BusinessID"][2 ** 40] == 2 ** 31
+
+
+def test_business_days_passed():
+    df = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 2, 3, 4],
+            "PaymentSchedule": ["daily", "weekly", "daily", "daily"],
+            "bdstartdate": [
+                datetime(2019, 12, 19, 0, 0, 0),
+                datetime(2019, 12, 15, 0, 0, 0),
+                datetime(2019, 12, 20, 0, 0, 0),
+                pd.NaT,
+            ],
+        }
+    )
+    date = pd.to_datetime("2019-12-31")
+    df["dayspassed"] = dd.business_days_passed(df, date)
+    assert df.dayspassed.isnull().sum() == 2
+    assert df.dayspassed.sum() == 15
+
+
+def test_dates_by_subtracting_business_minutes():
+    rng = np.random.default_rng(0)
+    from_dates = [
+        pd.to_datetime("2020-01-03"),
+        pd.to_datetime("2020-01-04"),
+        pd.to_datetime("2020-01-06"),
+        pd.to_datetime("2020-07-06 13:45:30"),
+        pd.to_datetime("2020-12-28"),
+    ]
+    minutes = np.concatenate([[0, 1, 1439, 1440, 1441, 2880], rng.integers(0, 6000, 12)])
+    for from_date in from_dates:
+        result = dd.dates_by_subtracting_business_minutes(minutes, from_date)
+        expected = [dd.date_by_subtracting_business_minutes(int(x), from_date) for x in minutes]
+        assert list(pd.to_datetime(result)) == expected
+
+
+def test_weeks_passed():
+    today = datetime(2020, 1, 17, 0, 0, 0)
+    df = pd.DataFrame.from_dict(
+        {
+            "PaymentSchedule": ["weekly", "daily", "weekly", "weekly", "weekly"],
+            "bdstartdate": [
+                datetime(2020, 1, 10, 0, 0, 0),
+                datetime(2020, 1, 1, 0, 0, 0),
+                datetime(2020, 1, 1, 0, 0, 0),
+                datetime(2020, 1, 18, 0, 0, 0),
+                datetime(2019, 12, 20, 12, 0, 0),
+            ],
+        }
+    )
+    df["weekspassed"] = dd.weeks_passed(df, today)
+    expected = [dd.weeks_between(x, today) for x in df["bdstartdate"]]
+    assert df.weekspassed.isnull().sum() == 1
+    assert df.weekspassed[df.PaymentSchedule == "weekly"].to_list() == [
+        x for x, s in zip(expected, df.PaymentSchedule) if s == "weekly"
+    ]
+
+
+def test_business_calendar(tmp_path):
+    calendar = dd.BusinessCalendar(start="2015-01-01", end="2021-12-31")
+    rng = np.random.default_rng(0)
+    begin = np.datetime64("2014-06-01") + rng.integers(0, 2900, 200).astype("timedelta64[D]")
+    end = np.datetime64("2014-06-01") + rng.integers(0, 2900, 200).astype("timedelta64[D]")
+    offsets = rng.integers(-400, 400, 200)
+    holidays = dd.federal_holidays("2021-12-31", "2015-01-01")
+    expected = np.busday_count(begin, end, holidays=holidays)
+    assert np.array_equal(calendar.count(begin, end), expected)
+    expected = np.busday_offset(begin, offsets, roll="forward", holidays=holidays)
+    assert np.array_equal(calendar.offset(begin, offsets), expected)
+    calendar.save(str(tmp_path / "calendar.npz"))
+    loaded = dd.BusinessCalendar.load(str(tmp_path / "calendar.npz"))
+    assert np.array_equal(loaded.ordinal, calendar.ordinal)
+
+
+def test_expected_amount():
+    df = pd.DataFrame.from_dict(
+        {
+            "DailyPayment": [0, 100, 200],
+            "PaymentSchedule": ["daily", "weekly", "daily"],
+            "weekspassed": [2, 3, 2],
+            "dayspassed": [10, 20, 10],
+        }
+    )
+    df["ExpectedAmt"] = dd.expected_amount(df)
+    assert df.ExpectedAmt.isnull().sum() == 1
+    assert df.ExpectedAmt.sum() == 3500
+
+
+def test_override_expectedamt():
+    today = pd.to_datetime("2020-08-14")
+    df = pd.DataFrame.from_dict(
+        {
+            "LoanID": [27, 99, 99, 56, 56, 56, 56, 1],
+            "dayspassed": [10, 20, 60, 50, 103, 150, np.nan, 10],
+            "ExpectedAmt": [1, 1, 1, 1, 1, 1, 1, 1],
+            "AmtOwedAdj": [10 ** 6] * 8,
+        }
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        df = dd.expectedamt_cleaning(df, today)
+        weeks = dd.weeks_elapsed(pd.to_datetime(["2020-07-15", None]), today)
+    nweeks = dd.weeks_between(pd.to_datetime("2020-7-15"), today)
+    assert weeks[0] == nweeks
+    assert np.isnan(weeks[1])
+    expected = [
+        50600 + 4500 * nweeks,
+        55 * 213 + (20 - 55) * 700,
+        55 * 213 + (60 - 55) * 700,
+        50 * 200,
+        103 * 200,
+        103 * 200 + (150 - 103) * 500,
+        np.nan,
+        1,
+    ]
+    assert np.allclose(df["ExpectedAmt"], expected, equal_nan=True)
+
+
+def test_get_remain_loan_term():
+    date = pd.to_datetime("2020-01-31")
+    df = pd.DataFrame.from_dict(
+        {
+            "Loandate": [
+                datetime(2020, 1, 1, 0, 0, 0),
+                datetime(2019, 12, 1, 0, 0, 0),
+                datetime(2019, 11, 1, 0, 0),
+            ],
+            "AmtOwedAdj": [100, 200, 300],
+            "AmtPaidTodatehack": [60, 20, 30],
+            "DailyPayment": [20, 30, 40],
+            "calcloan_term": [2, 4, 1],
+        }
+    )
+    df = dd.get_remain_loan_term(df, date)
+    assert np.allclose(df["loan_term_diff"], [30 / 30.436875, 61 / 30.436875, 91 / 30.436875])
+    assert np.allclose(df["remaining_term"], [2 - 30 / 30.436875, 4 - 61 / 30.436875, 8.75 / 30])
+
+
+def test_bins_categories():
+    df = pd.DataFrame.from_dict(
+        {
+            "CalDays": [2, 6, np.nan, np.inf],
+            "AnnualRevenue": [np.nan, 5000, 300000, 140000],
+            "YearsInBusiness": [2, np.nan, 23, 0],
+            "CreditScore": [425, 525, 619, np.nan],
+            "CreditScore2": [619, 475, 551, 300],
+        }
+    )
+    df = dd.bins(df)
+    assert df.DelinquencyBins.isnull().sum() == 2
+    assert all(df.AnnualRevenueBins.values == ["No Rev Info", "0-119K", "200-499K", "120-174K"])
+    assert all(df.AnnualRevenueBins2.values == ["No Rev Info", "0-174K", "200K+", "0-174K"])
+    assert all(df.YIBbins.values == ["2", "No Info", "20-24", "0"])
+    assert df.CreditScorebins.dtype == df.CreditScore2bins.dtype
+    assert df.CreditScore2bins.isnull().sum() == 1
+
+
+def test_stage_plan():
+    plan = [stage["name"] for stage in dd.stage_plan(["DelinquencyBins"])]
+    assert plan == ["time_passed", "expected_amount", "delinquent", "caldays", "DelinquencyBins"]
+    assert [stage["name"] for stage in dd.stage_plan(["LoanID", "YIBbins"])] == ["YIBbins"]
+    assert dd.stage_plan(["LoanID", "loanBalance"]) == []
+    assert dd.stage_columns(["remaining_term"]) == {
+        "remaining_term",
+        "Loandate",
+        "AmtOwedAdj",
+        "AmtPaidTodatehack",
+        "DailyPayment",
+        "calcloan_term",
+    }
+
+
+def test_run_stages(monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    today = pd.to_datetime("2020-03-02")
+    df = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 2, 3],
+            "Loandate": pd.to_datetime(["2019-12-01", "2020-01-01", "2020-02-01"]),
+            "AmtOwedAdj": [10000, 5000, 8000],
+            "AmtPaidTodatehack": [2000, 4900, 0],
+            "DailyPayment": [100, 50, 80],
+            "calcloan_term": [6, 3, 4],
+            "YearsInBusiness": [2, np.nan, 23],
+            "minutesbehind": [1, 2, 3],
+        }
+    )
+    result = dd.run_stages(df.copy(), ["LoanID", "remaining_term", "YIBbins"], {"today": today})
+    assert list(result) == ["LoanID", "remaining_term", "YIBbins"]
+    expected = dd.get_remain_loan_term(df.copy(), today)
+    assert np.allclose(result["remaining_term"], expected["remaining_term"])
+    assert all(result.YIBbins.values == ["2", "No Info", "20-24"])
+
+
+def test_backend_parity(monkeypatch):
+    pytest.importorskip("polars")
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    today = pd.to_datetime("2020-03-01")
+    engine = trn_source()
+    bank = dd.read_sql("select * from reporting.vw_BankTransactions_transactions", engine)
+    adj = dd.read_sql("select * from reporting.vw_AdjustmentTransactions_transactions", engine)
+    activefunds = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 2, 3, 4, 6],
+            "Loandate": pd.to_datetime(["2019-12-01", "2019-12-15", "2020-01-01", "2020-04-01", "2019-11-01"]),
+            "FirstTransaction": pd.to_datetime(["2019-12-02", "2019-12-16", "2020-01-02", "2020-04-02", "2019-11-02"]),
+            "AmtOwedAdj": [1000, 500, 60, 800, 300],
+            "DailyPayment": [10, 5, 2, 8, 0.5],
+        }
+    )
+    results = {}
+    for name in ["pandas", "polars"]:
+        ops = dd.get_backend(name)
+        mindate = ops["min_BankTransactions_date"](bank)
+        agg = ops["get_trn_agg"](dd.get_paid_bank(bank.copy()), dd.get_paid_adj(adj.copy()))
+        results[name] = (mindate, agg, ops["base_frame"](activefunds.copy(), agg, mindate, today))
+    for expected, result in zip(results["pandas"], results["polars"]):
+        pd.testing.assert_frame_equal(
+            expected.reset_index(drop=expected.index.name is None),
+            result.reset_index(drop=result.index.name is None),
+            check_dtype=False,
+        )
+
+
+def test_get_backend():
+    with pytest.raises(ValueError):
+        dd.get_backend("spark")
+
+
+def test_timed(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    monkeypatch.setattr(dd, "STAGE_METRICS", [])
+    monkeypatch.setattr(dd, "PROFILE_STAGE", "select_df")
+    monkeypatch.setattr(dd, "PROFILE_DIR", str(tmp_path))
+    df = pd.DataFrame.from_dict(
+        {
+            "Loandate": pd.to_datetime(["2020-01-01", "2020-05-01", "2020-01-01"]),
+            "DailyPayment": [10, 10, 0],
+            "loanBalance": [100, 100, 100],
+        }
+    )
+    result = dd.timed("select_df", dd.select_df, df, pd.to_datetime("2020-03-01"))
+    assert len(result) == 1
+    metrics = dd.STAGE_METRICS[0]
+    assert metrics["stage"] == "select_df"
+    assert (metrics["rows_in"], metrics["rows_out"]) == (3, 1)
+    assert metrics["traced_peak_mb"] is None
+    assert (tmp_path / "select_df.prof").exists()
+    with dd.stage_tags(date="2020-03-01"):
+        with dd.stage_tags(shard=1):
+            dd.timed("select_df", dd.select_df, df, pd.to_datetime("2020-03-01"))
+        dd.timed("select_df", dd.select_df, df, pd.to_datetime("2020-03-01"))
+    assert (dd.STAGE_METRICS[1]["date"], dd.STAGE_METRICS[1]["shard"]) == ("2020-03-01", 1)
+    assert "shard" not in dd.STAGE_METRICS[2]
+    assert dd.STAGE_TAGS == {}
+    dd.write_run_report(tmp_path / "run.json", upload_type="daily")
+    report = pd.read_json(tmp_path / "run.json", typ="series")
+    assert report["upload_type"] == "daily"
+    assert report["stages"][0]["stage"] == "select_df"
+
+
+def test_bulk_load(monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    engine = sq.create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("attach database ':memory:' as reports")
+        conn.exec_driver_sql(
+            "create table reports.delinquency_daily (loan_id integer, loan_balance float, "
+            "bins_delinquency text, date timestamp)"
+        )
+    session = sessionmaker(bind=engine)()
+    df = pd.DataFrame.from_dict(
+        {
+            "loan_id": np.array([1, 2, 3, 4, 5], dtype="int32"),
+            "loan_balance": [100.5, np.nan, 0, 12, 7],
+            "bins_delinquency": pd.Categorical(["0-3", None, "4-14", "0-3", "180+"]),
+            "date": pd.to_datetime(["2020-03-02", None, "2020-03-02", "2020-03-02", "2020-03-02"]),
+        }
+    )
+    assert dd.bulk_load(session, df, "delinquency_daily", batch_size=2) == 5
+    session.commit()
+    result = pd.read_sql(
+        "select * from reports.delinquency_daily order by loan_id", session.connection(), parse_dates=["date"]
+    )
+    pd.testing.assert_frame_equal(result, df.astype({"bins_delinquency": object}), check_dtype=False)
+
+
+def test_copy_batches():
+    class Copy:
+        def __init__(self, calls, query):
+            self.calls, self.query = calls, query
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def write(self, data):
+            self.calls.append((self.query, data))
+
+    class Cursor:
+        def __init__(self):
+            self.calls = []
+
+        def copy_expert(self, query, buffer):
+            self.calls.append((query, buffer.read()))
+
+        def copy(self, query):
+            return Copy(self.calls, query)
+
+    df = pd.DataFrame.from_dict({"loan_id": [1, 2, 3], "loan_balance": [1.5, np.nan, 2.0]})
+    calls = {}
+    for driver in ["psycopg2", "psycopg"]:
+        cursor = Cursor()
+        dd.copy_batches(cursor, df, "delinquency_daily", "reports", 2, driver)
+        calls[driver] = cursor.calls
+    assert calls["psycopg2"] == calls["psycopg"]
+    assert [data for _, data in calls["psycopg"]] == ["1,1.5\n2,\n", "3,2.0\n"]
+    assert calls["psycopg"][0][0] == 'copy reports.delinquency_daily ("loan_id", "loan_balance") from stdin with csv'
+
+
+def test_bulk_records():
+    df = pd.DataFrame.from_dict(
+        {
+            "loan_id": [1, 2, 3, 4],
+            "loan_balance": [1.5, np.nan, 2.5, 3.5],
+            "date": pd.to_datetime(["2020-03-02", None, "2020-03-03", "2020-03-04"]),
+        }
+    )
+    df.index = [10, 11, 12, 13]
+    records = dd.bulk_records(df.iloc[1:])
+    assert [record["date"] for record in records] == [None, datetime(2020, 3, 3), datetime(2020, 3, 4)]
+    assert records[0]["loan_balance"] is None
+    assert all(type(record["date"]) is datetime for record in records[1:])
+
+
+def test_publish_partition(monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    engine = sq.create_engine("sqlite://")
+
+    @sq.event.listens_for(engine, "connect")
+    def attach_reports(dbapi_connection, connection_record):
+        dbapi_connection.execute("attach database ':memory:' as reports")
+
+    Base = declarative_base()
+
+    class Daily(Base):
+        __tablename__ = "delinquency_daily"
+        __table_args__ = (sq.Index("ix_delinquency_daily_balance", "loan_balance"), {"schema": "reports"})
+        loan_id = sq.Column(sq.Integer, primary_key=True)
+        date = sq.Column(sq.DateTime, primary_key=True)
+        loan_balance = sq.Column(sq.Float)
+
+    session = sessionmaker(bind=engine)()
+    Base.metadata.create_all(session.connection())
+    old = pd.to_datetime(["2020-03-02", "2020-03-02", "2020-03-03"])
+    session.add_all(
+        [Daily(loan_id=i, date=d.to_pydatetime(), loan_balance=1.0) for i, d in zip([1, 2, 1], old)]
+    )
+    session.commit()
+    today = pd.to_datetime("2020-03-03")
+    df = pd.DataFrame.from_dict(
+        {"loan_id": [1, 2, 3], "date": [today] * 3, "loan_balance": [5.0, 6.0, np.nan]}
+    )
+    assert dd.publish_partition(session, df, Daily, today, batch_size=2) == 3
+    result = pd.read_sql(
+        "select * from reports.delinquency_daily order by date, loan_id", session.connection(), parse_dates=["date"]
+    )
+    assert len(result) == 5
+    assert result["loan_balance"].tolist()[:2] == [1.0, 1.0]
+    assert result["loan_balance"].tolist()[2:4] == [5.0, 6.0]
+    staging = pd.read_sql("select * from reports.delinquency_daily_staging", session.connection())
+    assert staging.empty
+    with pytest.raises(Exception):
+        dd.publish_partition(session, df.assign(extra=1), Daily, today)
+    assert len(pd.read_sql("select * from reports.delinquency_daily", session.connection())) == 5
+
+
+def test_as_of_aggregate():
+    bank = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 1, 2, 2, 3, 1],
+            "Transdate": pd.to_datetime(
+                ["2020-01-02", "2020-01-01", "2020-01-05", "2020-02-05", "2020-03-03", "2020-02-01"]
+            ),
+            "AmtPaid": [100, 50, 0, 30, 20, 10],
+            "AmtCharged": [0, 5, 10, 0, 0, 1],
+        }
+    )
+    dates = pd.to_datetime(["2019-12-31", "2020-01-05", "2020-02-05", "2020-03-01"])
+    aggs = dd.as_of_aggregate(bank, dates, "AmtPaid", "AmtCharged", "bankamt")
+    assert len(aggs) == 4
+    assert aggs[0].empty
+    for date, agg in zip(dates[1:], aggs[1:]):
+        expected = dd.aggregate(bank[bank["Transdate"] <= date], "AmtPaid", "AmtCharged", "bankamt")
+        pd.testing.assert_frame_equal(agg, expected, check_dtype=False)
+
+
+def test_loans_as_of():
+    loans = pd.DataFrame.from_dict({"LoanID": [1, 2, 3, 4], "AmtOwed": [10, 20, 30, 40]})
+    ranks = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 2, 3, 4],
+            "BusinessID": [7, 7, 7, 8],
+            "Loandate": pd.to_datetime(["2020-01-01", "2020-02-01", "2020-03-01", "2020-01-15"]),
+        }
+    )
+    df = dd.loans_as_of(loans, ranks, pd.to_datetime("2020-02-15"))
+    assert df["rnkactive"].tolist()[:2] == [2, 1]
+    assert np.isnan(df["rnkactive"][2])
+    assert df["rnkactive"][3] == 1
+
+
+def test_payment_index(tmp_path):
+    bank = pd.DataFrame.from_dict(
+        {
+            "LoanID": [1, 1, 2, 2, 3, 1],
+            "Transdate": pd.to_datetime(
+                ["2020-01-02", "2020-01-01", "2020-01-05", "2020-02-05", "2020-03-03", "2020-02-01"]
+            ),
+            "AmtPaid": [100, 50, 0, 30, 20, 10],
+            "AmtCharged": [0, 5, 10, 0, 0, 1],
+        }
+    )
+    adj = pd.DataFrame.from_dict(
+        {
+            "LoanID": [2, 4, 1],
+            "Transdate": pd.to_datetime(["2020-01-10", "2020-01-20", "2020-02-10"]),
+            "OwedAmtAmtPaid": [5, 7, 0],
+            "OwedAmtAmtCharged": [0, 0, 3],
+        }
+    )
+    index = dd.PaymentIndex.from_transactions(bank, adj)
+    index.save(tmp_path / "regular.npz")
+    loaded = dd.PaymentIndex.load(tmp_path / "regular.npz")
+    for date in pd.to_datetime(["2019-12-31", "2020-01-05", "2020-02-05", "2020-03-01", "2020-04-01"]):
+        expected = dd.get_trn_agg(bank[bank["Transdate"] <= date], adj[adj["Transdate"] <= date])
+        agg, mindate = loaded.frames(date)
+        pd.testing.assert_frame_equal(
+            agg, expected.sort_index(), check_dtype=False, check_index_type=False
+        )
+        pd.testing.assert_frame_equal(
+            mindate,
+            dd.min_BankTransactions_date(bank[bank["Transdate"] <= date]),
+            check_dtype=False,
+            check_index_type=False,
+        )
+    assert np.isnan(index.paid([5], "2020-03-01")[0])
+
+
+def test_publish_ready(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    uploaded = []
+    monkeypatch.setattr(dd, "upload", lambda session, df, upload_type, cleardate, *args: uploaded.append(cleardate))
+    keys = ["2020-01-01", "2020-02-01", "2020-03-01", "2020-04-01"]
+    status = {
+        "2020-01-01": {"status": "published", "attempts": 1, "error": None},
+        "2020-02-01": {"status": "computed", "attempts": 1, "error": None},
+        "2020-03-01": {"status": "failed", "attempts": 3, "error": "boom"},
+        "2020-04-01": {"status": "computed", "attempts": 1, "error": None},
+    }
+    os.makedirs(tmp_path / "frames")
+    for key in ["2020-02-01", "2020-04-01"]:
+        pd.DataFrame({"LoanID": [1]}).to_parquet(tmp_path / "frames" / f"{key}.parquet")
+    dd.publish_ready(None, str(tmp_path), status, keys, False, 10, False)
+    assert uploaded == [pd.to_datetime("2020-02-01")]
+    assert os.listdir(tmp_path / "frames") == ["2020-04-01.parquet"]
+    status = dd.load_backfill_status(str(tmp_path))
+    assert status["2020-02-01"]["status"] == "published"
+    assert status["2020-03-01"] == {"status": "pending", "attempts": 0, "error": "boom"}
+
+
+def test_shard_filter():
+    date = pd.to_datetime("2020-01-31")
+    cnxn = trn_source()
+    pd.DataFrame.from_dict({"LoanID": [1, 2, 3, 4], "BusinessID": [1, 2, np.nan, -1]}).to_sql(
+        "Loans", cnxn, index=False
+    )
+    full = dd.get_trn_agg(dd.get_paid_bank(dd.get_bank_data(date, cnxn)), dd.get_paid_adj(dd.get_adj_data(date, cnxn)))
+    shards = []
+    for index in range(2):
+        shard = (index, 2)
+        bank = dd.get_bank_data(date, cnxn, shard=shard)
+        adj = dd.get_adj_data(date, cnxn, shard=shard)
+        assert set(bank["LoanID"]).union(adj["LoanID"]) <= {1, 2, 3, 4, 5}
+        shards.append(dd.get_trn_agg(dd.get_paid_bank(bank), dd.get_paid_adj(adj)))
+        aggbank = dd.get_bank_agg_data(date, cnxn, shard=shard)
+        pushdown = dd.merge_trn_agg(aggbank[["bankamt"]], dd.get_adj_agg_data(date, cnxn, shard=shard))
+        pd.testing.assert_frame_equal(shards[-1].sort_index(), pushdown.sort_index(), check_dtype=False)
+    assert [sorted(shard.index) for shard in shards] == [[2, 3, 5], [1, 4]]
+    pd.testing.assert_frame_equal(pd.concat(shards).sort_index(), full.sort_index(), check_dtype=False)
+
+
+def test_backfill_frames_parity(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    cnxn = build_source_db(n_loans=40, trans_per_loan=10, path=tmp_path)
+    cleardates = dd.backfill_dates("2020-01-01", "2020-07-01")[::3]
+    sources = dd.backfill_sources(cnxn, dd.analysis_date(cleardates[-1]), workers=2)
+    for cleardate, df in dd.backfill_frames(sources, cleardates):
+        expected = dd.compute_df(cnxn, dd.analysis_date(cleardate), date=cleardate, workers=2)
+        expected = dd.data_cleaning(dd.remove_and_rename(expected))
+        assert len(df) > 0
+        pd.testing.assert_frame_equal(
+            df.sort_values("loan_id").reset_index(drop=True),
+            expected.sort_values("loan_id").reset_index(drop=True),
+            check_dtype=False,
+            check_categorical=False,
+        )
+
+
+def test_payments_as_of(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    cnxn = build_source_db(n_loans=40, trans_per_loan=10, path=tmp_path)
+    cleardates = dd.backfill_dates("2020-01-01", "2020-07-01")[::3]
+    today = dd.analysis_date(cleardates[-1])
+    dd.build_payment_indexes(today, cnxn, str(tmp_path / "indexes"))
+    indexes = dd.load_payment_indexes(str(tmp_path / "indexes"))
+    for cleardate in cleardates:
+        expected = dd.compute_df(cnxn, dd.analysis_date(cleardate), workers=2)
+        df = dd.payments_as_of(indexes, expected, dd.analysis_date(cleardate))
+        for column in ["AmtPaidTodatehack", "loanBalance", "firstBankTransactionsdate"]:
+            pd.testing.assert_series_equal(df[column], expected[column], check_dtype=False)
+    sources = dd.backfill_sources(cnxn, today, workers=2)
+    indexed = {key: sources[key] for key in ["loans", "ranks"]}
+    indexed["indexes"] = indexes
+    for (_, df), (_, expected) in zip(
+        dd.backfill_frames(indexed, cleardates), dd.backfill_frames(sources, cleardates)
+    ):
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+
+def test_compute_sharded_df(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    monkeypatch.setattr(dd, "STAGE_METRICS", [])
+    cnxn = build_source_db(n_loans=40, trans_per_loan=10, path=tmp_path)
+    with cnxn.begin() as conn:
+        conn.exec_driver_sql("update Loans set BusinessID = null where LoanID in (1000, 1001)")
+        conn.exec_driver_sql("update Loans set BusinessID = -BusinessID where LoanID in (1002, 1003)")
+    today = pd.to_datetime("2020-06-03")
+    expected = dd.compute_df(cnxn, today, workers=2)
+    df = dd.compute_sharded_df(cnxn, today, 3, processes=2, engine_options=source_options(str(tmp_path)), workers=2)
+    assert len(df) > 0
+    assert {metrics.get("shard") for metrics in dd.STAGE_METRICS} == {None, 0, 1, 2}
+    pd.testing.assert_frame_equal(
+        df.sort_values("LoanID").reset_index(drop=True),
+        expected.sort_values("LoanID").reset_index(drop=True),
+        check_dtype=False,
+        check_categorical=False,
+    )
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork", reason="the workers only see the patched backfill_frames when forked"
+)
+def test_parallel_backfill(tmp_path, monkeypatch):
+    monkeypatch.setattr(dd, "log", get_logger(), raising=False)
+    cnxn = build_source_db(n_loans=40, trans_per_loan=10, path=tmp_path)
+    uploaded = []
+    monkeypatch.setattr(
+        dd, "upload", lambda session, df, upload_type, cleardate, *args: uploaded.append((cleardate, df))
+    )
+    dd.backfill(cnxn, None, "2020-01-01", "2020-06-01", workers=2)
+    serial, uploaded[:] = list(uploaded), []
+    backfill_frames = dd.backfill_frames
+    state_dir = tmp_path / "state"
+
+    """ calls are counted in a file as the workers don't share memory """
+
+    def computed(name, cleardates):
+        with open(tmp_path / name, "a") as f:
+            f.write(f"{cleardates[0]:%Y-%m-%d}\n")
+
+    def failing(sources, cleardates, *args):
+        if cleardates[0] == pd.to_datetime("2020-03-01"):
+            computed("failed", cleardates)
+            raise RuntimeError("boom")
+        return backfill_frames(sources, cleardates, *args)
+
+    monkeypatch.setattr(dd, "backfill_frames", failing)
+    with pytest.raises(RuntimeError, match="2020-03-01"):
+        dd.parallel_backfill(cnxn, None, "2020-01-01", "2020-06-01", str(state_dir), processes=2, retries=1)
+    assert (tmp_path / "failed").read_text().split() == ["2020-03-01"] * 2
+    with open(state_dir / "status.json") as f:
+        status = json.load(f)
+    assert status["2020-03-01"] == {"status": "failed", "attempts": 2, "error": "RuntimeError('boom')"}
+    assert [status[key]["status"] for key in ["2020-01-01", "2020-02-01", "2020-04-01", "2020-05-01", "2020-06-01"]] == [
+        "published", "published", "computed", "computed", "computed"
+    ]
+    assert [cleardate for cleardate, _ in uploaded] == list(pd.to_datetime(["2020-01-01", "2020-02-01"]))
+    assert sorted(os.listdir(state_dir / "frames")) == ["2020-04-01.parquet", "2020-05-01.parquet", "2020-06-01.parquet"]
+
+    def counted(sources, cleardates, *args):
+        computed("resumed", cleardates)
+        return backfill_frames(sources, cleardates, *args)
+
+    monkeypatch.setattr(dd, "backfill_frames", counted)
+    dd.parallel_backfill(cnxn, None, "2020-01-01", "2020-06-01", str(state_dir), processes=2, retries=1)
+    assert (tmp_path / "resumed").read_text().split() == ["2020-03-01"]
+    assert {entry["status"] for entry in dd.load_backfill_status(str(state_dir)).values()} == {"published"}
+    assert os.listdir(state_dir / "frames") == []
+    assert [cleardate for cleardate, _ in uploaded] == [cleardate for cleardate, _ in serial]
+    for (_, df), (_, expected) in zip(uploaded, serial):
+        assert len(df) > 0
+        pd.testing.assert_frame_equal(
+            df.reset_index(drop=True),
+            expected.reset_index(drop=True),
+            check_dtype=False,
+            check_categorical=False,
+        )